@@ -0,0 +1,114 @@
+"""
+Preprocessed text corpus for random page sampling without loading the corpus into memory.
+
+A corpus directory contains:
+    text.bin     all cleaned documents concatenated, as UCS-2 (uint16)
+    docs.npz     document keys and start offsets into text.bin
+    words.npy    start offset of every word in text.bin
+    word_docs.npy  document index of every word
+"""
+import os
+import random
+from typing import Tuple
+
+import numpy as np
+
+from data.text import TextLoader
+
+CORPUS_TEXT_FILENAME = "text.bin"
+CORPUS_DOCS_FILENAME = "docs.npz"
+CORPUS_WORDS_FILENAME = "words.npy"
+CORPUS_WORD_DOCS_FILENAME = "word_docs.npy"
+
+
+def build_corpus(loader: TextLoader, dataset_name, output_dir, processes=None, verbose=False):
+    """
+    Cleans all text files in `dataset_name` with `loader` and writes them as a corpus directory
+    that can be opened with Corpus. Files are streamed, so the corpus is never held in memory.
+
+    :param loader: TextLoader with the character set to keep. All characters must be in the BMP.
+    :param dataset_name: text dataset directory (see `TextLoader.iter_data`)
+    :param output_dir: directory to write the corpus to
+    :param processes: number of processes used to load files
+    :param verbose: show progress bar
+    """
+    if any(ord(c) > 0xFFFF for c in loader.character_set):
+        raise ValueError("Corpus text is stored as UCS-2; all characters must be in the BMP")
+    os.makedirs(output_dir, exist_ok=True)
+
+    keys = []
+    doc_offsets = [0]
+    words = []
+    word_docs = []
+    with open(os.path.join(output_dir, CORPUS_TEXT_FILENAME), "wb") as f:
+        for key, text in loader.iter_data(dataset_name, verbose=verbose, processes=processes):
+            if not text:
+                continue
+            array = np.frombuffer(text.encode("utf-16-le"), dtype=np.uint16)
+            f.write(array.tobytes())
+
+            # Cleaned text has single spaces between words and no leading or trailing spaces
+            starts = np.concatenate([[0], np.flatnonzero(array == ord(" ")) + 1]) + doc_offsets[-1]
+            words.append(starts)
+            word_docs.append(np.full(len(starts), len(keys), dtype=np.int32))
+            keys.append(key)
+            doc_offsets.append(doc_offsets[-1] + len(array))
+
+    np.savez(os.path.join(output_dir, CORPUS_DOCS_FILENAME), keys=np.array(keys),
+             offsets=np.array(doc_offsets, dtype=np.int64))
+    np.save(os.path.join(output_dir, CORPUS_WORDS_FILENAME),
+            np.concatenate(words).astype(np.int64) if words else np.zeros(0, dtype=np.int64))
+    np.save(os.path.join(output_dir, CORPUS_WORD_DOCS_FILENAME),
+            np.concatenate(word_docs) if word_docs else np.zeros(0, dtype=np.int32))
+
+
+class Corpus:
+    """
+    Memory-mapped corpus written by `build_corpus`. Page-sized windows starting at a random word can
+    be drawn in constant time.
+    """
+
+    def __init__(self, corpus_dir):
+        """
+        :param corpus_dir: directory written by `build_corpus`
+        """
+        self.corpus_dir = corpus_dir
+        with np.load(os.path.join(corpus_dir, CORPUS_DOCS_FILENAME)) as docs:
+            self.keys = [str(key) for key in docs["keys"].tolist()]
+            self.offsets = docs["offsets"]
+        path = os.path.join(corpus_dir, CORPUS_TEXT_FILENAME)
+        if os.path.getsize(path):
+            self.text = np.memmap(path, dtype=np.uint16, mode="r")
+        else:
+            self.text = np.zeros(0, dtype=np.uint16)  # np.memmap can't map empty files
+        self.words = np.load(os.path.join(corpus_dir, CORPUS_WORDS_FILENAME), mmap_mode="r")
+        self.word_docs = np.load(os.path.join(corpus_dir, CORPUS_WORD_DOCS_FILENAME), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get_text(self, doc, start=0, end=None) -> str:
+        """
+        :param doc: document index
+        :param start: start offset within the document
+        :param end: end offset within the document (end of document if None)
+        :return: document text
+        """
+        doc_start, doc_end = self.offsets[doc], self.offsets[doc + 1]
+        end = doc_end if end is None else min(doc_start + end, doc_end)
+        return self.text[doc_start + start:end].tobytes().decode("utf-16-le")
+
+    def sample_window(self, length, rng=random) -> Tuple[str, int, str]:
+        """
+        Returns up to `length` characters starting at a random word. Every word in the corpus is
+        equally likely, so longer documents are sampled more often. Windows don't cross documents.
+
+        :param length: max characters
+        :param rng: source of randomness, e.g., a seeded random.Random
+        :return: (key, offset within the document, text)
+        """
+        word = rng.randrange(len(self.words))
+        doc = int(self.word_docs[word])
+        offset = int(self.words[word] - self.offsets[doc])
+        return self.keys[doc], offset, self.get_text(doc, offset, offset + length)
+
@@ -6,70 +6,764 @@ glyph: image of a character
 import glob
 import os
 import re
+import tempfile
 import warnings
-from collections import defaultdict
-from functools import lru_cache
+from collections import defaultdict, OrderedDict
+from multiprocessing import shared_memory
 from typing import Set
 import random
+
+import numpy as np
 from PIL import Image
 
+from data import stats
+
+PACKED_DATA_FILENAME = "glyphs.bin"
+PACKED_INDEX_FILENAME = "index.npz"
+PACKED_NORMALIZED_FILENAME = "normalized.npy"
+GLYPH_MANIFEST_FILENAME = ".glyph_manifest.npz"
+GLYPH_MANIFEST_VERSION = 1
+GLYPH_CACHE_BYTES = 256 * 1024 * 1024  # default memory budget of the glyph cache per GlyphLoader
+TRIM_THRESHOLD = 100  # same cutoff as generator.trim
+SPECIAL_CHARACTERS = ['.', ',', '?', ';', '!', '"', '\'', '/', '\'', '~', '@', '#', '%', '^', '&', '*', '(', ')', '-',
+                      '+', '>', '<', '[', ']', '{', '}', '₩']  # not trimmed when rendered
+
+
+def compute_bbox(array, threshold=TRIM_THRESHOLD):
+    """
+    Returns the ink bounding box of a glyph, i.e., the box containing all pixels that differ from
+    the top-left (background) pixel by more than `threshold`. Matches `generator.trim`.
+
+    :param array: (height, width) uint8 glyph
+    :return: (left, upper, right, lower) or None if the glyph is blank
+    """
+    diff = np.abs(array.astype(np.int16) - int(array[0, 0])) > threshold
+    rows = np.flatnonzero(diff.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(diff.any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+def normalize_glyph_array(array, bbox, size, trim=True) -> Image.Image:
+    """
+    Trims a glyph to `bbox` (if `trim`) and resizes it to `size`.
+
+    :param array: (height, width) uint8 glyph
+    :param bbox: ink bounding box from `compute_bbox`
+    :param size: (width, height) of the output glyph
+    :return: grayscale ("L") image
+    """
+    img = Image.fromarray(np.asarray(array), mode="L")
+    if trim and bbox:
+        img = img.crop(bbox)
+    return img.resize(tuple(size), Image.LANCZOS)
+
+
+def scan_glyph_dir(dataset_dir, ext="tif"):
+    """
+    Lists a glyph dataset laid out as <dataset_dir>/<pid>/<hex>.<ext>. Every pid must have the same
+    characters.
+
+    :return: (sorted pids, character set of hex codes)
+    """
+    paths = glob.glob(os.path.join(dataset_dir, "*/*.{}".format(ext)), recursive=True)
+    re_path = re.compile(".*/([^/]*)/([0-9A-Fa-f]{4})." + ext)
+
+    if len(paths) == 0:
+        raise ValueError("No .{} files found in dataset_dir {}".format(ext, dataset_dir))
+
+    pids = set()
+    d = defaultdict(set) # { pid: [ chars ], ... }
+    for path in paths:
+        match = re_path.match(path)
+        if not match:
+            raise ValueError("Invalid file found in dataset_dir {}: {}".format(dataset_dir, path))
+        pid, char = match.groups()
+        pids.add(pid)
+        d[pid].add(char)
+    pids = sorted(list(pids))
+
+    character_set = d[pids[0]]
+    for pid in pids:
+        assert(character_set == d[pid])
+    return pids, character_set
+
+
+def read_glyph_manifest(manifest_path, dataset_dir, ext="tif", verify_files=False):
+    """
+    Reads the dataset listing written by `write_glyph_manifest`. Adding, removing or renaming glyph
+    files changes the mtime of their directory, so listing the subdirectories of dataset_dir and
+    checking their mtimes (one stat per pid) is enough to detect a changed listing.
+    With `verify_files`, the size and mtime of every glyph file is checked as well, which also
+    catches files that were overwritten in place.
+
+    :return: (pids, character set), or None if there is no manifest or it is out of date
+    """
+    try:
+        with open(manifest_path, "rb") as f, np.load(f) as manifest:
+            if int(manifest["version"]) != GLYPH_MANIFEST_VERSION or str(manifest["ext"]) != ext:
+                return _manifest_miss("version")
+            pids = [str(pid) for pid in manifest["pids"].tolist()]
+            characters = [str(c) for c in manifest["characters"].tolist()]
+            dirs, dir_mtimes = _subdir_mtimes(dataset_dir)
+            if dirs != manifest["dirs"].tolist() or dir_mtimes != manifest["dir_mtimes"].tolist():
+                return _manifest_miss("stale")
+            if verify_files:
+                sizes, mtimes = _file_fingerprints(dataset_dir, ext, pids, characters)
+                if not (np.array_equal(sizes, manifest["sizes"]) and np.array_equal(mtimes, manifest["mtimes"])):
+                    return _manifest_miss("stale")
+    except FileNotFoundError:
+        return _manifest_miss("missing")
+    except Exception as e:  # e.g., a truncated file raises BadZipFile or EOFError
+        warnings.warn("Ignoring invalid glyph manifest {}: {}".format(manifest_path, e))
+        return _manifest_miss("invalid")
+    stats.increment("glyph.manifest.hits")
+    return pids, set(characters)
+
+
+def write_glyph_manifest(manifest_path, dataset_dir, ext, pids, character_set):
+    """
+    Writes the dataset listing along with directory mtimes and per-file (size, mtime) fingerprints.
+    Failures (e.g., a read-only dataset_dir) are reported as warnings, as the manifest is only a
+    cache. Each process writes to its own temporary file, so workers that start at the same time
+    on a new dataset never publish each other's partial writes.
+    """
+    characters = sorted(character_set)
+    tmp_path = None
+    try:
+        dirs, dir_mtimes = _subdir_mtimes(dataset_dir)
+        sizes, mtimes = _file_fingerprints(dataset_dir, ext, pids, characters)
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(manifest_path) + ".", suffix=".tmp",
+                                        dir=os.path.dirname(manifest_path) or ".")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, version=GLYPH_MANIFEST_VERSION, ext=ext, pids=np.array(pids),
+                     characters=np.array(characters), dirs=np.array(dirs),
+                     dir_mtimes=np.array(dir_mtimes, dtype=np.int64),
+                     sizes=sizes, mtimes=mtimes)
+        os.chmod(tmp_path, 0o644)  # mkstemp creates files readable by the owner only
+        os.replace(tmp_path, manifest_path)
+    except OSError as e:
+        warnings.warn("Could not write glyph manifest {}: {}".format(manifest_path, e))
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _subdir_mtimes(dataset_dir):
+    """
+    :return: (sorted names of the subdirectories of dataset_dir, their mtimes in ns)
+    """
+    entries = sorted((entry.name, entry.stat().st_mtime_ns) for entry in os.scandir(dataset_dir) if entry.is_dir())
+    return [name for name, _ in entries], [mtime for _, mtime in entries]
+
+
+def _file_fingerprints(dataset_dir, ext, pids, characters):
+    """
+    :return: (sizes, mtimes) as (pids, characters) int64 arrays
+    """
+    sizes = np.empty((len(pids), len(characters)), dtype=np.int64)
+    mtimes = np.empty((len(pids), len(characters)), dtype=np.int64)
+    for i, pid in enumerate(pids):
+        for j, char in enumerate(characters):
+            st = os.stat(os.path.join(dataset_dir, pid, "{}.{}".format(char, ext)))
+            sizes[i, j] = st.st_size
+            mtimes[i, j] = st.st_mtime_ns
+    return sizes, mtimes
+
+
+def _manifest_miss(reason):
+    stats.increment("glyph.manifest.{}".format(reason))
+    return None
+
+
+class GlyphCache:
+    """
+    LRU cache of glyph images bounded by memory (bytes of pixel data) rather than by number of
+    entries. Holds both decoded glyphs, keyed by (character, variant), and normalized glyphs, keyed
+    by (character, variant, size, trim). Pinned glyphs are never evicted, but count towards the budget.
+    """
+
+    def __init__(self, max_bytes=GLYPH_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # { key: Image }, least recently used first
+        self.pinned = dict()  # { key: Image }
+        self.bytes = 0
+        self.pinned_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        img = self.pinned.get(key)
+        if img is None:
+            img = self.entries.get(key)
+            if img is not None:
+                self.entries.move_to_end(key)
+        if img is None:
+            self.misses += 1
+            stats.increment("glyph.cache.misses")
+        else:
+            self.hits += 1
+            stats.increment("glyph.cache.hits")
+        return img
+
+    def put(self, key, img, pin=False):
+        if key in self.pinned or key in self.entries:
+            if pin:
+                self.pin(key)
+            return
+        size = image_nbytes(img)
+        if pin:
+            self.pinned[key] = img
+            self.pinned_bytes += size
+        else:
+            self.entries[key] = img
+        self.bytes += size
+        while self.bytes > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= image_nbytes(evicted)
+            self.evictions += 1
+            stats.increment("glyph.cache.evictions")
+
+    def pin(self, key):
+        if key in self.entries:
+            img = self.entries.pop(key)
+            self.pinned[key] = img
+            self.pinned_bytes += image_nbytes(img)
+
+    def clear(self):
+        self.entries.clear()
+        self.pinned.clear()
+        self.bytes = 0
+        self.pinned_bytes = 0
+
+    def __len__(self):
+        return len(self.entries) + len(self.pinned)
+
+
+def image_nbytes(img: Image.Image):
+    """
+    :return: size of the decoded pixel data of an image (PIL stores "1" images with a byte per pixel)
+    """
+    return img.width * img.height * len(img.getbands())
+
+
+class BaseGlyphLoader:
+    """
+    Interface shared by GlyphLoader (a directory of glyph files) and PackedGlyphLoader (a packed
+    glyph set). Subclasses set `character_set`, `pids` and `variants`, call `_init_cache` and
+    implement `_read_glyph`.
+    """
 
-class GlyphLoader:
-    def __init__(self, dataset_dir, ext="tif"):
+    def _init_cache(self, cache_bytes):
+        self.cache = GlyphCache(cache_bytes)
+        self.bboxes = dict()  # { (character, variant_index): bbox }
+
+    def check_glyph(self, character, variant_index):
         """
-        :param dataset_dir:
+        :raise ValueError: if the glyph set has no such character or variant
         """
-        self.dataset_dir = dataset_dir
-        self.ext = ext
+        if not 0 <= variant_index < self.variants:
+            raise ValueError("Invalid variant index")
+        if "{:04X}".format(ord(character)) not in self.character_set:
+            raise ValueError("Character not in glyph set: {}".format(character))
+
+    def load_glyph(self, character, variant_index, pin=False):
+        """
+        :param character: "가", "나", "다", etc.
+        :param variant_index: Whose handwriting? Range: [0, len(self.variants)) (random if None)
+        :param pin: keep the glyph in the cache permanently
+        :return: decoded image (cached, don't modify)
+        """
+        key = (character, variant_index)
+        img = self.cache.get(key)
+        if img is None:
+            img = self._read_glyph(character, variant_index)
+            self.cache.put(key, img, pin)
+        elif pin:
+            self.cache.pin(key)
+        return img
+
+    def _read_glyph(self, character, variant_index):
+        """
+        Decodes a glyph, bypassing the cache.
+        """
+        raise NotImplementedError
+
+    def _read_glyph_array(self, character, variant_index):
+        """
+        Like `load_glyph_array`, but bypasses the cache.
+        """
+        return np.asarray(self._read_glyph(character, variant_index).convert("L"))
+
+    def warm_cache(self, frequencies, fraction=0.5, variants=None, size=None):
+        """
+        Loads and pins the glyphs of the most frequent characters until pinned glyphs use `fraction`
+        of the cache budget, so that evictions only hit rarer characters.
 
-        paths = glob.glob(os.path.join(dataset_dir, "*/*.{}".format(ext)), recursive=True)
-        re_path = re.compile(".*/([^/]*)/([0-9A-Fa-f]{4})." + ext)
+        :param frequencies: { character: count }, e.g., from TextLoader.character_frequencies
+        :param fraction: fraction of the cache budget to fill with pinned glyphs
+        :param variants: variant indices to pin (all if None)
+        :param size: (width, height). If specified, pin the normalized glyphs of this size that the
+        generator renders pages from (see `load_normalized_glyph`) instead of the decoded glyphs.
+        :return: number of pinned characters
+        """
+        variants = range(self.variants) if variants is None else variants
+        budget = self.cache.max_bytes * fraction
+        pinned = 0
+        for character, _ in sorted(frequencies.items(), key=lambda item: item[1], reverse=True):
+            if self.cache.pinned_bytes >= budget:
+                break
+            if "{:04X}".format(ord(character)) not in self.character_set:
+                continue
+            for variant_index in variants:
+                if size is None:
+                    self.load_glyph(character, variant_index, pin=True)
+                else:
+                    self.load_normalized_glyph(character, variant_index, size, trim=character not in SPECIAL_CHARACTERS,
+                                               pin=True)
+            pinned += 1
+        return pinned
+
+    def cache_stats(self):
+        """
+        :return: { name: value } statistics of the glyph caches
+        """
+        cache = self.cache
+        return {
+            "glyph.cache.hits": cache.hits,
+            "glyph.cache.misses": cache.misses,
+            "glyph.cache.evictions": cache.evictions,
+            "glyph.cache.size": len(cache),
+            "glyph.cache.bytes": cache.bytes,
+            "glyph.cache.pinned_bytes": cache.pinned_bytes,
+            "glyph.bboxes.size": len(self.bboxes),
+        }
+
+    def load_glyph_array(self, character, variant_index):
+        """
+        :param character: "가", "나", "다", etc.
+        :param variant_index: Whose handwriting? Range: [0, len(self.variants))
+        :return: grayscale glyph as a (height, width) uint8 array
+        """
+        return np.asarray(self.load_glyph(character, variant_index).convert("L"))
+
+    def load_glyph_bbox(self, character, variant_index, array=None):
+        """
+        Ink bounding box of a glyph. Computed once per glyph and cached.
 
-        if len(paths) == 0:
-            raise ValueError("No .{} files found in dataset_dir {}".format(ext, dataset_dir))
+        :param array: the glyph from `load_glyph_array`, if already loaded
+        :return: (left, upper, right, lower) or None if the glyph is blank
+        """
+        key = (character, variant_index)
+        if key not in self.bboxes:
+            if array is None:
+                array = self.load_glyph_array(character, variant_index)
+            self.bboxes[key] = compute_bbox(array)
+        return self.bboxes[key]
 
-        pids = set()
-        d = defaultdict(set) # { pid: [ chars ], ... }
-        for path in paths:
-            match = re_path.match(path)
-            if not match:
-                raise ValueError("Invalid file found in dataset_dir {}: {}".format(dataset_dir, path))
-            pid, char = match.groups()
-            pids.add(pid)
-            d[pid].add(char)
-        pids = sorted(list(pids))
+    def load_normalized_glyph(self, character, variant_index, size, trim=True, pin=False):
+        """
+        Returns a glyph that is trimmed to its ink bounding box and resized to `size`. Results are
+        kept in the glyph cache, so callers in the render loop don't need to trim or resize glyphs
+        themselves.
 
-        character_set = d[pids[0]]
-        for pid in pids:
-            assert(character_set == d[pid])
+        :param character: "가", "나", "다", etc.
+        :param variant_index: Whose handwriting? Range: [0, len(self.variants))
+        :param size: (width, height) of the output glyph
+        :param trim: whether to trim the glyph before resizing (special characters are not trimmed)
+        :param pin: keep the glyph in the cache permanently
+        :return: grayscale ("L") image of the given size (cached, don't modify)
+        """
+        key = (character, variant_index, tuple(size), trim)
+        img = self.cache.get(key)
+        if img is None:
+            with stats.timer("glyph.normalize"):
+                img = self._normalize_glyph(character, variant_index, key[2], trim)
+            self.cache.put(key, img, pin)
+        elif pin:
+            self.cache.pin(key)
+        return img
+
+    def _normalize_glyph(self, character, variant_index, size, trim):
+        # The decoded glyph isn't cached: the render loop only reads normalized glyphs
+        array = self._read_glyph_array(character, variant_index)
+        bbox = self.load_glyph_bbox(character, variant_index, array) if trim else None
+        return normalize_glyph_array(array, bbox, size, trim)
+
+    def load_random_glyph(self, character):
+        """
+        :param character: "가", "나", "다", etc.
+        :param variant_index: Whose handwriting? Range: [0, len(self.variants)) (random if None)
+        :return:
+        """
+        variant_index = random.randint(0, len(self.pids))
+        return self.load_glyph(character, variant_index)
+
+
+class GlyphLoader(BaseGlyphLoader):
+    def __init__(self, dataset_dir, ext="tif", cache_bytes=GLYPH_CACHE_BYTES, use_manifest=True,
+                 manifest_path=None, verify_files=False):
+        """
+        :param dataset_dir:
+        :param cache_bytes: memory budget of the decoded and normalized glyphs (see GlyphCache)
+        :param use_manifest: reuse the dataset listing from a manifest instead of scanning
+        dataset_dir, and write one after scanning (see `read_glyph_manifest`)
+        :param manifest_path: default: <dataset_dir>/{GLYPH_MANIFEST_FILENAME}
+        :param verify_files: also check the size and mtime of every glyph file against the manifest
+        """
+        self.dataset_dir = dataset_dir
+        self.ext = ext
+
+        if manifest_path is None:
+            manifest_path = os.path.join(dataset_dir, GLYPH_MANIFEST_FILENAME)
+        index = None
+        if use_manifest:
+            index = read_glyph_manifest(manifest_path, dataset_dir, ext, verify_files=verify_files)
+        if index is None:
+            with stats.timer("glyph.scan"):
+                index = scan_glyph_dir(dataset_dir, ext)
+            if use_manifest:
+                write_glyph_manifest(manifest_path, dataset_dir, ext, *index)
+        pids, character_set = index
 
         self.character_set = character_set
         self.pids = pids
         self.variants = len(pids)
+        self._init_cache(cache_bytes)
 
     def load_glyph_path(self, character, variant_index):
-        if not 0 <= variant_index < len(self.pids):
-            raise ValueError("Invalid variant index")
+        self.check_glyph(character, variant_index)
         pid = self.pids[variant_index]
         hex = "{:04X}".format(ord(character))
         path = os.path.join(self.dataset_dir, pid, "{}.{}".format(hex, self.ext))
         return path
 
-    @lru_cache(maxsize=5000)
-    def load_glyph(self, character, variant_index):
+    def _read_glyph(self, character, variant_index):
+        path = self.load_glyph_path(character, variant_index)
+        with stats.timer("glyph.load"):
+            # Decode now so that the file is closed and the image holds pixel data only
+            with Image.open(path) as img:
+                img.load()
+        return img
+
+
+class PackedGlyphLoader(BaseGlyphLoader):
+    """
+    Serves glyphs from a packed glyph set created by `pack_glyphs`. All glyphs live in a single
+    contiguous uint8 file that is memory-mapped, so glyphs are returned as zero-copy views and all
+    processes that open the same packed set share the OS page cache.
+
+    Same interface as GlyphLoader, except for `load_glyph_path`: packed sets have no glyph files.
+    Cached glyphs are views into the packed data (except for normalized glyphs of a size that
+    isn't stored in the packed set), so they count towards the cache budget without using memory
+    of their own.
+    """
+
+    def __init__(self, packed_dir, cache_bytes=GLYPH_CACHE_BYTES):
         """
-        :param character: "가", "나", "다", etc.
-        :param variant_index: Whose handwriting? Range: [0, len(self.variants)) (random if None)
-        :return:
+        :param packed_dir: directory written by `pack_glyphs`
+        :param cache_bytes: memory budget of the glyph cache (see GlyphCache)
         """
-        path = self.load_glyph_path(character, variant_index)
-        return Image.open(path)
+        data_path = os.path.join(packed_dir, PACKED_DATA_FILENAME)
+        index_path = os.path.join(packed_dir, PACKED_INDEX_FILENAME)
+        if not os.path.isfile(data_path) or not os.path.isfile(index_path):
+            raise ValueError("No packed glyph set found in {}".format(packed_dir))
 
-    def load_random_glyph(self, character):
+        with np.load(index_path) as index:
+            index = dict(index)
+        # Packed sets written before bounding boxes were added don't have them
+        index.setdefault("bboxes", None)
+
+        normalized_path = os.path.join(packed_dir, PACKED_NORMALIZED_FILENAME)
+        if os.path.isfile(normalized_path):
+            normalized = np.load(normalized_path, mmap_mode="r")
+        else:
+            normalized = None
+
+        self.dataset_dir = packed_dir
+        self._init_packed(np.memmap(data_path, dtype=np.uint8, mode="r"), index, normalized, cache_bytes)
+
+    def _init_packed(self, data, index, normalized=None, cache_bytes=GLYPH_CACHE_BYTES):
+        """
+        :param data: flat uint8 array of all glyphs
+        :param index: { "characters", "pids", "offsets", "shapes", "bboxes" } as written by `pack_glyphs`
+        :param normalized: (characters, variants, height, width) trimmed (except for special
+        characters) and resized glyphs, if available
+        :param cache_bytes:
+        """
+        codes = index["characters"].tolist()
+        self.data = data
+        self.offsets = index["offsets"]
+        self.shapes = index["shapes"]
+        self.packed_bboxes = index["bboxes"]
+        self.packed_normalized = normalized
+        self.rows = {chr(code): row for row, code in enumerate(codes)}
+
+        self.character_set = set("{:04X}".format(code) for code in codes)
+        self.pids = [str(pid) for pid in index["pids"].tolist()]
+        self.variants = len(self.pids)
+        self._init_cache(cache_bytes)
+
+    def load_glyph_array(self, character, variant_index):
         """
         :param character: "가", "나", "다", etc.
-        :param variant_index: Whose handwriting? Range: [0, len(self.variants)) (random if None)
-        :return:
+        :param variant_index: Whose handwriting? Range: [0, len(self.variants))
+        :return: read-only (height, width) uint8 view into the packed data
         """
-        variant_index = random.randint(0, len(self.pids))
-        return self.load_glyph(character, variant_index)
+        self.check_glyph(character, variant_index)
+        row = self.rows[character]
+        offset = self.offsets[row, variant_index]
+        height, width = self.shapes[row, variant_index]
+        return self.data[offset:offset + height * width].reshape(height, width)
+
+    def _read_glyph(self, character, variant_index):
+        return Image.fromarray(self.load_glyph_array(character, variant_index), mode="L")
+
+    def _read_glyph_array(self, character, variant_index):
+        return self.load_glyph_array(character, variant_index)
+
+    def load_glyph_bbox(self, character, variant_index, array=None):
+        if self.packed_bboxes is None:
+            return super().load_glyph_bbox(character, variant_index, array)
+        self.check_glyph(character, variant_index)
+        bbox = self.packed_bboxes[self.rows[character], variant_index]
+        if bbox[2] == 0:
+            return None  # blank glyph
+        return tuple(int(v) for v in bbox)
+
+    def _normalize_glyph(self, character, variant_index, size, trim):
+        normalized = self.packed_normalized
+        if (normalized is not None and (normalized.shape[3], normalized.shape[2]) == size and
+                trim == (character not in SPECIAL_CHARACTERS)):
+            self.check_glyph(character, variant_index)
+            array = normalized[self.rows[character], variant_index]
+            return Image.fromarray(array, mode="L")
+        return super()._normalize_glyph(character, variant_index, size, trim)
+
+
+def pack_glyphs(gl: BaseGlyphLoader, output_dir, normalized_size=None, verbose=False):
+    """
+    Writes all glyphs of a loader into a packed glyph set that can be opened with
+    PackedGlyphLoader. Glyphs are converted to grayscale and stored back-to-back in
+    `glyphs.bin`; `index.npz` maps each (character, variant) to its offset, shape and
+    ink bounding box.
+
+    :param gl: source loader
+    :param output_dir: directory to write the packed glyph set to
+    :param normalized_size: (width, height). If specified, also store trimmed and resized glyphs
+    (see `GlyphLoader.load_normalized_glyph`) in `normalized.npy`
+    :param verbose: show progress bar
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    codes = sorted(int(character, 16) for character in gl.character_set)
+    offsets = np.zeros((len(codes), gl.variants), dtype=np.int64)
+    shapes = np.zeros((len(codes), gl.variants, 2), dtype=np.int32)
+    bboxes = np.zeros((len(codes), gl.variants, 4), dtype=np.int32)  # all zeros for blank glyphs
+    if normalized_size:
+        normalized = np.lib.format.open_memmap(
+            os.path.join(output_dir, PACKED_NORMALIZED_FILENAME), mode="w+", dtype=np.uint8,
+            shape=(len(codes), gl.variants, normalized_size[1], normalized_size[0]))
+
+    rows = enumerate(codes)
+    if verbose:
+        import tqdm
+        rows = tqdm.tqdm(rows, total=len(codes))
+
+    offset = 0
+    with open(os.path.join(output_dir, PACKED_DATA_FILENAME), "wb") as f:
+        for row, code in rows:
+            for variant_index in range(gl.variants):
+                # Bypass the loader cache, which would only evict glyphs that are never read again
+                array = gl._read_glyph_array(chr(code), variant_index)
+                f.write(array.tobytes())
+                offsets[row, variant_index] = offset
+                shapes[row, variant_index] = array.shape
+                offset += array.size
+
+                bbox = compute_bbox(array)
+                if bbox:
+                    bboxes[row, variant_index] = bbox
+                if normalized_size:
+                    img = normalize_glyph_array(array, bbox, normalized_size, chr(code) not in SPECIAL_CHARACTERS)
+                    normalized[row, variant_index] = np.asarray(img)
+
+    np.savez(os.path.join(output_dir, PACKED_INDEX_FILENAME),
+             characters=np.array(codes, dtype=np.uint32),
+             pids=np.array(gl.pids),
+             offsets=offsets,
+             shapes=shapes,
+             bboxes=bboxes)
+    if normalized_size:
+        normalized.flush()
+
+
+class SharedGlyphLoader(PackedGlyphLoader):
+    """
+    PackedGlyphLoader whose glyph data lives in shared memory (see `share_glyphs`). Pickling it only
+    sends the names of the shared memory segments and the index, so it can be handed to worker
+    processes cheaply and all workers read the same physical memory.
+
+    The process that created the segments should call `unlink` once all workers are done.
+    """
+
+    def __init__(self, data_name, index, normalized_name=None, normalized_shape=None):
+        """
+        :param data_name: name of the shared memory segment with the packed glyph data
+        :param index: see `PackedGlyphLoader._init_packed`
+        :param normalized_name: name of the shared memory segment with normalized glyphs
+        :param normalized_shape: shape of the normalized glyph array
+        """
+        self.dataset_dir = None
+        self.data_name = data_name
+        self.index = index
+        self.normalized_name = normalized_name
+        self.normalized_shape = normalized_shape
+
+        # The segment may be larger than requested (rounded up to the page size)
+        shapes = index["shapes"].astype(np.int64)
+        size = int((shapes[:, :, 0] * shapes[:, :, 1]).sum())
+        self.data_shm = shared_memory.SharedMemory(name=data_name)
+        data = np.ndarray((size,), dtype=np.uint8, buffer=self.data_shm.buf)
+        if normalized_name:
+            self.normalized_shm = shared_memory.SharedMemory(name=normalized_name)
+            normalized = np.ndarray(normalized_shape, dtype=np.uint8, buffer=self.normalized_shm.buf)
+        else:
+            self.normalized_shm = None
+            normalized = None
+        self._init_packed(data, index, normalized)
+
+    def __reduce__(self):
+        return SharedGlyphLoader, (self.data_name, self.index, self.normalized_name, self.normalized_shape)
+
+    def close(self):
+        """
+        Detaches from the shared memory segments. The loader can't be used afterwards.
+        """
+        self.data = None
+        self.packed_normalized = None
+        self.cache.clear()  # cached glyphs may be views into the segments
+        for shm in (self.data_shm, self.normalized_shm):
+            if shm is not None:
+                shm.close()
+
+    def unlink(self):
+        """
+        Detaches from and frees the shared memory segments. Call once, from the creating process.
+        """
+        self.close()
+        for shm in (self.data_shm, self.normalized_shm):
+            if shm is not None:
+                shm.unlink()
+
+
+def share_glyphs(gl: BaseGlyphLoader, normalized_size=None) -> SharedGlyphLoader:
+    """
+    Copies all glyphs of a loader into shared memory. Equivalent to `pack_glyphs` followed by
+    PackedGlyphLoader, except that nothing is written to disk. Each glyph is decoded once.
+
+    :param gl: source loader
+    :param normalized_size: (width, height). If specified, also share trimmed and resized glyphs
+    (see `BaseGlyphLoader.load_normalized_glyph`)
+    :return: SharedGlyphLoader. Call `unlink` when done.
+    """
+    codes = sorted(int(character, 16) for character in gl.character_set)
+    packed = isinstance(gl, PackedGlyphLoader)
+    offsets = np.zeros((len(codes), gl.variants), dtype=np.int64)
+    shapes = np.zeros((len(codes), gl.variants, 2), dtype=np.int32)
+    bboxes = np.zeros((len(codes), gl.variants, 4), dtype=np.int32)  # all zeros for blank glyphs
+    data_shm = None
+    normalized_shm = None
+    normalized_shape = None
+    normalized = None
+    try:
+        if normalized_size:
+            normalized_shape = (len(codes), gl.variants, normalized_size[1], normalized_size[0])
+            normalized_shm = shared_memory.SharedMemory(create=True, size=int(np.prod(normalized_shape)))
+            normalized = np.ndarray(normalized_shape, dtype=np.uint8, buffer=normalized_shm.buf)
+        if packed:
+            # Assumes that gl.character_set is sorted like gl.rows, which holds for packed sets
+            offsets, shapes = gl.offsets, gl.shapes
+            data_shm = shared_memory.SharedMemory(create=True, size=max(int(gl.data.size), 1))
+            data_shm.buf[:gl.data.size] = gl.data
+
+        offset = 0
+        for row, code in enumerate(codes):
+            character = chr(code)
+            for variant_index in range(gl.variants):
+                if packed:
+                    bbox = gl.load_glyph_bbox(character, variant_index)
+                else:
+                    array = gl._read_glyph_array(character, variant_index)
+                    if data_shm is None or offset + array.size > data_shm.size:
+                        # The segment is sized as glyphs are decoded. Glyphs of a set usually have
+                        # the same size, so the first estimate is usually final.
+                        estimate = array.size * len(codes) * gl.variants
+                        data_shm = _resize_shared_memory(data_shm, offset, max(estimate, 2 * (offset + array.size)))
+                    data_shm.buf[offset:offset + array.size] = np.ascontiguousarray(array).reshape(-1)
+                    offsets[row, variant_index] = offset
+                    shapes[row, variant_index] = array.shape
+                    offset += array.size
+                    bbox = compute_bbox(array)
+                if bbox:
+                    bboxes[row, variant_index] = bbox
+                if normalized_size:
+                    trim = character not in SPECIAL_CHARACTERS
+                    if packed:
+                        img = gl._normalize_glyph(character, variant_index, normalized_size, trim)  # not cached
+                    else:
+                        img = normalize_glyph_array(array, bbox, normalized_size, trim)
+                    normalized[row, variant_index] = np.asarray(img)
+        if data_shm is None:
+            data_shm = shared_memory.SharedMemory(create=True, size=1)  # no glyphs
+        elif not packed and data_shm.size - offset > offset // 8:
+            data_shm = _resize_shared_memory(data_shm, offset, offset)  # glyphs were larger than estimated
+
+        index = {
+            "characters": np.array(codes, dtype=np.uint32),
+            "pids": np.array(gl.pids),
+            "offsets": offsets,
+            "shapes": shapes,
+            "bboxes": bboxes,
+        }
+        shared = SharedGlyphLoader(data_shm.name, index, normalized_shm.name if normalized_shm else None,
+                                   normalized_shape)
+    except BaseException:
+        normalized = None  # release the buffer before closing the segment
+        for shm in (data_shm, normalized_shm):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        raise
+
+    # The loader holds its own handles to the segments
+    normalized = None
+    for shm in (data_shm, normalized_shm):
+        if shm is not None:
+            shm.close()
+    return shared
+
+
+def _resize_shared_memory(shm, used, size):
+    """
+    :param shm: segment to replace (unlinked), or None
+    :param used: number of bytes of `shm` to copy
+    :param size: size of the new segment
+    :return: new shared memory segment
+    """
+    resized = shared_memory.SharedMemory(create=True, size=size)
+    if shm is not None:
+        resized.buf[:used] = shm.buf[:used]
+        shm.close()
+        shm.unlink()
+    return resized
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) not in (3, 4):
+        print("Usage: python -m data.glyph <dataset_dir> <output_dir> [<width>x<height>]")
+        sys.exit(1)
+    size = tuple(int(v) for v in sys.argv[3].split("x")) if len(sys.argv) == 4 else None
+    pack_glyphs(GlyphLoader(sys.argv[1]), sys.argv[2], normalized_size=size, verbose=True)
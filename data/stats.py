@@ -0,0 +1,132 @@
+"""
+Opt-in run statistics: counters and stage timers shared by the loaders and the generator.
+
+Statistics are disabled by default, in which case `increment` and `timer` do (almost) nothing.
+Enable with `stats.enable()` or by setting the environment variable CALLIGRAM_STATS=1.
+
+Usage:
+    from data import stats
+
+    stats.enable()
+    with stats.timer("page.composite"):
+        ...
+    stats.increment("glyphs.rendered", len(placements))
+    stats.dump(stats.snapshot(), "stats.json")
+"""
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List
+
+_enabled = os.environ.get("CALLIGRAM_STATS") == "1"
+_counters = defaultdict(int)  # { name: value }
+_timers = defaultdict(lambda: [0, 0.0])  # { name: [count, seconds] }
+_lock = threading.Lock()  # statistics may be recorded from several threads
+
+
+def enable(enabled=True):
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled():
+    return _enabled
+
+
+def increment(name, value=1):
+    if _enabled:
+        with _lock:
+            _counters[name] += value
+
+
+@contextmanager
+def timer(name):
+    """
+    Adds the time spent in the block to timer `name`.
+    """
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def record(name, seconds, count=1):
+    """
+    Adds time measured elsewhere to timer `name`.
+    """
+    if _enabled:
+        with _lock:
+            entry = _timers[name]
+            entry[0] += count
+            entry[1] += seconds
+
+
+def snapshot(reset=False) -> Dict:
+    """
+    :param reset: clear all statistics after taking the snapshot, e.g., to send deltas from workers
+    :return: { "counters": { name: value }, "timers": { name: { "count": n, "seconds": s } } }
+    """
+    with _lock:
+        result = {
+            "counters": dict(_counters),
+            "timers": {name: {"count": count, "seconds": seconds} for name, (count, seconds) in _timers.items()},
+        }
+        if reset:
+            _counters.clear()
+            _timers.clear()
+    return result
+
+
+def clear():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+
+def merge(snapshots: List[Dict]) -> Dict:
+    """
+    Sums snapshots, e.g., from several worker processes.
+    """
+    counters = defaultdict(int)
+    timers = defaultdict(lambda: {"count": 0, "seconds": 0.0})
+    for s in snapshots:
+        for name, value in s["counters"].items():
+            counters[name] += value
+        for name, entry in s["timers"].items():
+            timers[name]["count"] += entry["count"]
+            timers[name]["seconds"] += entry["seconds"]
+    return {"counters": dict(counters), "timers": dict(timers)}
+
+
+def dump(snapshot, path):
+    """
+    Writes a snapshot to `path` as JSON, or in the Prometheus text format if `path` ends with
+    ".prom". The file is replaced atomically, so it can be read while a run is in progress.
+    """
+    if path.endswith(".prom"):
+        content = _format_prometheus(snapshot)
+    else:
+        content = json.dumps(dict(snapshot, time=time.time()), indent=2, sort_keys=True)
+    with open(path + ".tmp", "w") as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+
+
+def _format_prometheus(snapshot):
+    def metric(name):
+        return "calligram_" + name.replace(".", "_").replace("-", "_")
+
+    lines = []
+    for name, value in sorted(snapshot["counters"].items()):
+        lines.append("{}_total {}".format(metric(name), value))
+    for name, entry in sorted(snapshot["timers"].items()):
+        lines.append("{}_seconds_count {}".format(metric(name), entry["count"]))
+        lines.append("{}_seconds_sum {}".format(metric(name), entry["seconds"]))
+    return "\n".join(lines) + "\n"
@@ -1,41 +1,98 @@
-from typing import Dict, List
+from collections import Counter
+from multiprocessing import Pool
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
 import random
+import re
 import tqdm
 import os
 
+import numpy as np
+
+from data import stats
+
+READ_CHUNK_SIZE = 1 << 20  # characters
+
 
 class TextLoader:
     def __init__(self, character_list: List):
         self.character_list = character_list
         self.character_set = set(character_list)
+        # Matches runs of characters that are not in the character set
+        self.re_invalid = re.compile("[^{}]+".format("".join(re.escape(c) for c in sorted(self.character_set))))
 
-    def load_data(self, dataset_name=None, verbose=False) -> Dict:
+    def load_data(self, dataset_name=None, verbose=False, processes=None) -> Dict:
         """
         Returns a dictionary of dictionaries of all cleaned text data.
+        :param processes: number of processes used to load files (see `iter_data`)
         :return: {
             "text_id": string
         }
         """
-        count = 0
-        newdict = {}
+        return dict(self.iter_data(dataset_name, verbose=verbose, processes=processes))
+
+    def iter_data(self, dataset_name=None, verbose=False, processes=None) -> Iterator[Tuple[str, str]]:
+        """
+        Lazily loads and cleans all .txt files in the dataset directory, one file at a time.
 
+        :param dataset_name: dataset directory
+        :param verbose: show progress bar
+        :param processes: number of processes used to load files in parallel. Load in this process if None.
+        :return: iterator of (text_id, string)
+        """
+        paths = []
         for root, dirs, files in os.walk(dataset_name):
-            for name in tqdm.tqdm(files) if verbose else files:
+            for name in files:
                 if name.endswith(".txt"):
-                    string = ""
-                    fullpath = os.path.join(root, name)
-                    # open the file in read mode and save all the contents to a string
-                    with open(fullpath, "r") as file:
-                        for line in file:
-                            string += line
-
-                    cleaned_text = self.clean_string(string)
+                    paths.append(os.path.join(root, name))
+
+        if processes and processes > 1:
+            with Pool(processes) as pool:
+                # imap keeps the order of the files and only keeps a few results in flight
+                results = pool.imap(self.load_file, paths, chunksize=16)
+                yield from tqdm.tqdm(results, total=len(paths)) if verbose else results
+        else:
+            for path in tqdm.tqdm(paths) if verbose else paths:
+                yield self.load_file(path)
+
+    def load_file(self, path) -> Tuple[str, str]:
+        """
+        Loads and cleans a single text file. The file is read and filtered in large chunks.
 
-                    key = os.path.splitext(name)[0]
-                    newdict[key] = cleaned_text
+        :return: (text_id, string)
+        """
+        chunks = []
+        with stats.timer("text.load_file"):
+            with open(path, "r") as file:
+                while True:
+                    chunk = file.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    chunks.append(self.re_invalid.sub("", chunk))
+            string = " ".join("".join(chunks).split())
+
+        stats.increment("text.files")
+        stats.increment("text.characters", len(string))
+        key = os.path.splitext(os.path.basename(path))[0]
+        return key, string
+
+    @staticmethod
+    def character_frequencies(texts: Union[Dict[str, str], Iterable[str]]) -> Counter:
+        """
+        Counts how often each character occurs, e.g., to pin the most frequent glyphs in the
+        GlyphLoader cache (see `GlyphLoader.warm_cache`). Whitespace is not counted.
 
-        return newdict
-        # raise NotImplementedError()
+        :param texts: { text_id: string } (from `load_data`) or an iterable of strings
+        :return: Counter { character: count }
+        """
+        if isinstance(texts, dict):
+            texts = texts.values()
+        frequencies = Counter()
+        for text in texts:
+            frequencies.update(text)
+        for c in list(frequencies):
+            if c.isspace():
+                del frequencies[c]
+        return frequencies
 
     def generate_random_text(self, max_length=None) -> str:
         """
@@ -60,6 +117,69 @@ class TextLoader:
 
         return string.strip()
 
+    def generate_random_texts(self, count, length, weights=None, coverage=False, max_word_length=5,
+                              seed=None) -> List[str]:
+        """
+        Bulk version of `generate_random_text`. Word lengths and characters for all strings are
+        sampled at once with NumPy, so this produces millions of characters per second.
+
+        :param count: number of strings
+        :param length: length of each string, or a sequence of `count` lengths. Strings are
+        stripped, so they may be up to two characters shorter.
+        :param weights: relative probability of each character, as { character: weight } (missing
+        characters are never picked unless `coverage`) or a sequence aligned with `character_list`,
+        e.g., from `inverse_frequency_weights`. Uniform if None.
+        :param coverage: guarantee that every character appears at least once across all strings
+        :param max_word_length: max sequence length without space
+        :param seed: seed for reproducible strings
+        :return: list of strings
+        """
+        characters = [c for c in self.character_list if not c.isspace()]
+        codes = np.array([ord(c) for c in characters], dtype=np.uint32)
+        lengths = np.full(count, length, dtype=np.int64) if np.isscalar(length) else np.asarray(length, np.int64)
+        if len(lengths) != count:
+            raise ValueError("Expected {} lengths, got {}".format(count, len(lengths)))
+        rng = np.random.default_rng(seed)
+
+        p = None
+        if weights is not None:
+            if isinstance(weights, dict):
+                p = np.array([weights.get(c, 0) for c in characters], dtype=np.float64)
+            else:
+                p = np.array([w for c, w in zip(self.character_list, weights) if not c.isspace()], dtype=np.float64)
+            if p.sum() <= 0:
+                raise ValueError("Weights must not all be zero")
+            p /= p.sum()
+
+        # One stream of characters for all strings. Words of random length are separated by single
+        # spaces, so space positions are the cumulative sums of (word length + 1).
+        total = int(lengths.sum())
+        stream = codes[rng.choice(len(codes), size=total, p=p)]
+        word_lengths = rng.integers(1, max_word_length + 1, size=total // 2 + 1)
+        spaces = np.cumsum(word_lengths + 1) - 1
+        stream[spaces[spaces < total]] = ord(" ")
+
+        if coverage:
+            positions = np.flatnonzero(stream != ord(" "))
+            if len(positions) < len(codes):
+                raise ValueError("{} characters are too few to cover all {} characters".format(
+                    len(positions), len(codes)))
+            stream[rng.choice(positions, size=len(codes), replace=False)] = rng.permutation(codes)
+
+        text = stream.astype("<u4").tobytes().decode("utf-32-le")
+        ends = np.cumsum(lengths).tolist()
+        return [text[start:end].strip() for start, end in zip([0] + ends[:-1], ends)]
+
+    def inverse_frequency_weights(self, frequencies, smoothing=1.0) -> Dict[str, float]:
+        """
+        Weights for `generate_random_texts` that favor characters that are rare in a corpus.
+
+        :param frequencies: { character: count }, e.g., from `character_frequencies`
+        :param smoothing: added to each count, so unseen characters get a finite weight
+        :return: { character: weight }
+        """
+        return {c: 1 / (frequencies.get(c, 0) + smoothing) for c in self.character_list if not c.isspace()}
+
     def clean_string(self, original) -> str:
         """
         Removes all invalid characters from a string.
@@ -69,10 +189,7 @@ class TextLoader:
         :param original:
         :return:
         """
-        string = ""
-        for c in original:
-            if c in self.character_set:
-                string += c
+        string = self.re_invalid.sub("", original)
 
         # Remove repetitive spaces
         new_string = " ".join(string.split())
@@ -83,6 +200,8 @@ if __name__ == "__main__":
     loader = TextLoader(["가", "나", "다", "라", "마", ".", " "])
     text = loader.generate_random_text(max_length=10)
     print("Generated random text", text)
+    texts = loader.generate_random_texts(3, 10, coverage=True, seed=0)
+    print("Generated random texts", texts)
 
     clean_str = loader.clean_string("선(禪)의 시작은 부처님으로부터이다. 그런데 禪이란 쟈나의 음(音)을 그대로 <선나(禪那)>라고 쓰고 이를 한역하여 정려(瀞")
     print("clean text", clean_str)
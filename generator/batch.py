@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""
+Vectorized renderer that produces a batch of pages as a single (N, H, W) uint8 array
+"""
+
+import random
+from typing import List, Tuple
+
+import numpy as np
+
+from data import stats
+from data.glyph import BaseGlyphLoader, PackedGlyphLoader, SPECIAL_CHARACTERS
+from generator.generator import GLOBAL_CW_WIDTH, GLOBAL_CW_HEIGHT, PageLayout, layout_page, _rotated_size
+
+BATCH_GLYPH_CHUNK = 4096  # max number of glyphs to resample at once, to bound memory
+
+
+class GlyphStore:
+    """
+    Normalized (trimmed and resized) grayscale glyphs held in a single
+    (characters, variants, height, width) uint8 array. With a packed set that has normalized glyphs
+    of the right size, that array is the packed (memory-mapped or shared) one, not a copy.
+    """
+
+    def __init__(self, gl: BaseGlyphLoader, characters=None, size=(GLOBAL_CW_WIDTH, GLOBAL_CW_HEIGHT)):
+        """
+        :param gl:
+        :param characters: characters to load, e.g., TextLoader.character_list (all if None).
+        Whitespace is ignored.
+        :param size: (width, height) of the normalized glyphs
+        """
+        if characters is None:
+            characters = [chr(int(character, 16)) for character in sorted(gl.character_set)]
+        characters = sorted(set(c for c in characters if not c.isspace()))
+        self.size = tuple(size)
+        self.variants = gl.variants
+        self.rows = {c: row for row, c in enumerate(characters)}
+
+        packed = getattr(gl, "packed_normalized", None)
+        if (isinstance(gl, PackedGlyphLoader) and packed is not None and
+                (packed.shape[3], packed.shape[2]) == self.size and len(characters) == len(gl.rows)):
+            # Use the precomputed glyphs in the packed set directly
+            self.rows = gl.rows
+            self.glyphs = packed
+        else:
+            self.glyphs = np.empty((len(characters), gl.variants, self.size[1], self.size[0]), dtype=np.uint8)
+            for c, row in self.rows.items():
+                for variant in range(gl.variants):
+                    img = gl.load_normalized_glyph(c, variant, self.size, trim=c not in SPECIAL_CHARACTERS)
+                    self.glyphs[row, variant] = np.asarray(img)
+        self.flat = self.glyphs.reshape(-1)  # a view, as long as self.glyphs is contiguous
+
+    def glyph_offsets(self, characters, variants) -> np.ndarray:
+        """
+        :return: offset of each (character, variant) glyph in `self.flat`
+        """
+        rows = np.array([self.rows[c] for c in characters], dtype=np.int64)
+        width, height = self.size
+        return (rows * self.variants + np.asarray(variants, dtype=np.int64)) * height * width
+
+
+def generate_page_batch(store: GlyphStore, texts: List[str], variants: List[int],
+                        rng=random) -> Tuple[np.ndarray, List[str]]:
+    """
+    Vectorized counterpart of `generate_page_data`. Pages follow the same layout rules.
+
+    :param store: GlyphStore
+    :param texts: text for each page
+    :param variants: glyph variant for each page
+    :param rng: source of randomness for the layouts (see `layout_page`)
+    :return: (N, H, W) uint8 pages, texts (with linebreaks)
+    """
+    layouts = [layout_page(text, variant, rng) for text, variant in zip(texts, variants)]
+    return render_pages(store, layouts), ["\n".join(layout.lines) for layout in layouts]
+
+
+def render_pages(store: GlyphStore, layouts: List[PageLayout]) -> np.ndarray:
+    """
+    Renders page layouts into a single array. All glyphs in the batch are rotated and resampled
+    together, then blended onto white pages with np.minimum (dark ink over white). All layouts
+    must have the same page size.
+
+    :param store: GlyphStore
+    :param layouts: PageLayouts from `layout_page`
+    :return: (N, H, W) uint8 array
+    """
+    width, height = layouts[0].size
+    pages = np.full((len(layouts), height, width), 255, dtype=np.uint8)
+
+    placements = [(i, layout.variant, p) for i, layout in enumerate(layouts)
+                  for p in layout.placements if p.y < height]
+    for start in range(0, len(placements), BATCH_GLYPH_CHUNK):
+        chunk = placements[start:start + BATCH_GLYPH_CHUNK]
+        with stats.timer("batch.resample"):
+            cells = _resample_glyphs(store, chunk)
+        with stats.timer("batch.composite"):
+            for (i, _, p), cell in zip(chunk, cells):
+                h = min(p.height, height - p.y)
+                w = min(p.width, width - p.x)
+                region = pages[i, p.y:p.y + h, p.x:p.x + w]
+                np.minimum(region, cell[:h, :w], out=region)
+    stats.increment("pages.rendered", len(layouts))
+    stats.increment("glyphs.rendered", len(placements))
+    return pages
+
+
+def _resample_glyphs(store: GlyphStore, placements) -> np.ndarray:
+    """
+    Rotates each glyph by its placement's rotation (expanding the canvas like PIL's
+    `rotate(..., expand=True)`) and scales it to the placement size with bilinear sampling.
+
+    :param placements: list of (page index, variant, GlyphPlacement)
+    :return: (K, max height, max width) uint8 array. Pixels outside each placement are white.
+    """
+    src_w, src_h = store.size
+    offsets = store.glyph_offsets([p.character for _, _, p in placements],
+                                  [variant for _, variant, _ in placements])
+    widths = np.array([p.width for _, _, p in placements], dtype=np.float32)
+    heights = np.array([p.height for _, _, p in placements], dtype=np.float32)
+    theta = np.radians([p.rotation for _, _, p in placements]).astype(np.float32)
+    rotated = np.array([_rotated_size(src_w, src_h, p.rotation) for _, _, p in placements], dtype=np.float32)
+    rotated_w, rotated_h = rotated[:, 0], rotated[:, 1]
+
+    out_h, out_w = int(heights.max()), int(widths.max())
+    oy, ox = np.mgrid[0:out_h, 0:out_w].astype(np.float32)
+    # Offsets from the center of the rotated glyph, for every output pixel: (K, out_h, out_w)
+    dx = (ox[None] + 0.5) * (rotated_w / widths)[:, None, None] - (rotated_w / 2)[:, None, None]
+    dy = (oy[None] + 0.5) * (rotated_h / heights)[:, None, None] - (rotated_h / 2)[:, None, None]
+    cos, sin = np.cos(theta)[:, None, None], np.sin(theta)[:, None, None]
+    sx = cos * dx - sin * dy + src_w / 2 - 0.5
+    sy = sin * dx + cos * dy + src_h / 2 - 0.5
+
+    # Samples up to one pixel outside the glyph blend with white
+    sx = np.clip(sx, -1, src_w - 1e-3)
+    sy = np.clip(sy, -1, src_h - 1e-3)
+    x0 = np.floor(sx)
+    y0 = np.floor(sy)
+    fx = sx - x0
+    fy = sy - y0
+    x0 = x0.astype(np.int64)
+    y0 = y0.astype(np.int64)
+    # Neighbours outside the glyph (x0 == -1 or x0 + 1 == src_w, same for y) are white
+    left, right = x0 >= 0, x0 < src_w - 1
+    upper, lower = y0 >= 0, y0 < src_h - 1
+    x1 = np.minimum(x0 + 1, src_w - 1)
+    np.maximum(x0, 0, out=x0)
+    row0 = offsets[:, None, None] + np.maximum(y0, 0) * src_w
+    row1 = offsets[:, None, None] + np.minimum(y0 + 1, src_h - 1) * src_w
+
+    flat = store.flat
+    top = (np.where(upper & left, flat[row0 + x0], 255) * (1 - fx) +
+           np.where(upper & right, flat[row0 + x1], 255) * fx)
+    bottom = (np.where(lower & left, flat[row1 + x0], 255) * (1 - fx) +
+              np.where(lower & right, flat[row1 + x1], 255) * fx)
+    cells = top * (1 - fy) + bottom * fy
+    outside = (ox[None] >= widths[:, None, None]) | (oy[None] >= heights[:, None, None])
+    cells[outside] = 255
+    return np.rint(cells).astype(np.uint8)
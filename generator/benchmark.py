@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark for the page generator. Uses a synthetic glyph set generated locally, so no dataset
+download is needed. Results are written as JSON so they can be compared between commits.
+
+Usage:
+    python -m generator.benchmark --output bench.json --pages 20 --cw 20,35 --page-size 1000 --workers 1,4
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+import generator.generator as gen
+from data import stats
+from data.glyph import GlyphLoader, PackedGlyphLoader, pack_glyphs
+from generator.writer import PageWriter
+
+BENCHMARK_CHARACTERS = "가나다라마바사아자차카타파하계절이지는늘에을로득있습니.,?!"
+
+
+def make_synthetic_glyphs(output_dir, characters=BENCHMARK_CHARACTERS, variants=4, size=(110, 110), seed=0):
+    """
+    Writes a glyph set with random strokes in the same layout as hicau_mod0:
+    <output_dir>/<pid>/<hex>.tif
+
+    :return: output_dir
+    """
+    rng = random.Random(seed)
+    for variant in range(variants):
+        pid_dir = os.path.join(output_dir, "SYN_{:03d}".format(variant))
+        os.makedirs(pid_dir, exist_ok=True)
+        for c in characters:
+            img = Image.new("L", size, 255)
+            draw = ImageDraw.Draw(img)
+            for _ in range(rng.randint(3, 7)):
+                points = [(rng.randint(10, size[0] - 10), rng.randint(10, size[1] - 10)) for _ in range(2)]
+                draw.line(points, fill=0, width=rng.randint(3, 7))
+            img.convert("1").save(os.path.join(pid_dir, "{:04X}.tif".format(ord(c))))
+    return output_dir
+
+
+def benchmark_stages(glyph_dir, pages, compositor):
+    """
+    Generates and writes `pages` pages one at a time like a `run_job` worker, starting with an empty
+    glyph cache, and reports the stage timers recorded along the way (see data/stats.py). Timers
+    nest: page.composite includes glyph.normalize for cache misses, which includes glyph.load.
+
+    :return: { timer: { "seconds": total, "count": ops, "per_second": ops / seconds } }
+    """
+    text = _benchmark_text(gen.get_characters_per_page())
+    gl = GlyphLoader(glyph_dir)
+    enabled = stats.is_enabled()
+    stats.enable()
+    stats.clear()
+    try:
+        random.seed(0)
+        with tempfile.TemporaryDirectory() as output_dir:
+            # Encode and write synchronously, so that page.encode and page.write are timed per page
+            with PageWriter(output_dir, threads=0) as writer:
+                for i in range(pages):
+                    page, page_text = gen.generate_page_data(gl, text, i % gl.variants, compositor=compositor)
+                    writer.write("page{:04d}".format(i), page, page_text)
+        timers = stats.snapshot(reset=True)["timers"]
+    finally:
+        stats.enable(enabled)
+
+    return {name: {"seconds": timer["seconds"], "count": timer["count"],
+                   "per_second": timer["count"] / timer["seconds"] if timer["seconds"] else None}
+            for name, timer in timers.items()}
+
+
+def benchmark_end_to_end(glyph_dir, pages, workers):
+    """
+    Generates and writes `pages` pages with `run_job` using `workers` processes.
+
+    :return: { "seconds", "pages_per_second", "glyphs_per_second" }
+    """
+    characters_per_page = gen.get_characters_per_page()
+    text = _benchmark_text(characters_per_page)
+    glyphs_per_page = sum(1 for c in text if not c.isspace())
+    gl = PackedGlyphLoader(glyph_dir) if os.path.isfile(os.path.join(glyph_dir, "index.npz")) else GlyphLoader(
+        glyph_dir)
+    all_data = {"bench{:04d}".format(i): text for i in range(-(-pages // gl.variants))}
+    total = len(all_data) * gl.variants
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        gen.run_job(gl, all_data, output_dir, characters_per_page, chunk_size=max(1, total // (workers * 4)),
+                    max_workers=workers)
+        seconds = time.perf_counter() - start
+
+    return {
+        "seconds": seconds,
+        "pages": total,
+        "pages_per_second": total / seconds,
+        "glyphs_per_second": total * glyphs_per_page / seconds,
+    }
+
+
+def peak_rss_mb():
+    """
+    Peaks are over the lifetime of the process, so measure each configuration in a fresh process
+    (see `run_benchmarks`).
+
+    :return: peak resident set size of this process and of its largest (waited-for) child, in MB
+    """
+    scale = 1 / 1024 if sys.platform != "darwin" else 1 / 1024 / 1024  # ru_maxrss is KB on Linux, bytes on macOS
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
+
+
+def run_benchmarks(page_sizes, cw_sizes, workers, pages=20, variants=4, compositor="canvas", glyph_dir=None):
+    """
+    Runs the stage and end-to-end benchmarks for every combination of settings. Each combination
+    runs in a fresh subprocess, so that peak RSS is measured per combination.
+
+    :return: list of results
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        if glyph_dir is None:
+            glyph_dir = make_synthetic_glyphs(os.path.join(tmp, "glyphs"), variants=variants)
+        packed_dir = os.path.join(tmp, "packed")
+        pack_glyphs(GlyphLoader(glyph_dir), packed_dir)
+
+        for page_size, cw, n in itertools.product(page_sizes, cw_sizes, workers):
+            config = {"page_size": page_size, "cw": cw, "pages": pages, "compositor": compositor, "workers": n}
+            print("Benchmarking", config, file=sys.stderr)
+            results.append(_run_isolated(config, glyph_dir, packed_dir))
+    return results
+
+
+def benchmark_config(config, glyph_dir, packed_dir):
+    """
+    Runs the benchmarks for a single combination of settings in this process. GLOBAL_* settings of
+    generator.generator are changed for the run and restored afterwards (workers receive them
+    explicitly, see `generator._init_worker`).
+
+    :param config: { "page_size", "cw", "pages", "compositor", "workers" }
+    :return: result
+    """
+    settings = ("GLOBAL_WIDTH", "GLOBAL_HEIGHT", "GLOBAL_CW_WIDTH", "GLOBAL_CW_HEIGHT")
+    original = {name: getattr(gen, name) for name in settings}
+    try:
+        gen.GLOBAL_WIDTH = gen.GLOBAL_HEIGHT = config["page_size"]
+        gen.GLOBAL_CW_WIDTH = gen.GLOBAL_CW_HEIGHT = config["cw"]
+        return {
+            "config": config,
+            "stages": benchmark_stages(glyph_dir, config["pages"], config["compositor"]),
+            "end_to_end": benchmark_end_to_end(packed_dir, config["pages"], config["workers"]),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+    finally:
+        for name, value in original.items():
+            setattr(gen, name, value)
+
+
+def _run_isolated(config, glyph_dir, packed_dir):
+    """
+    Runs `benchmark_config` in a subprocess.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    args = [sys.executable, "-m", "generator.benchmark", "--run-config",
+            json.dumps({"config": config, "glyph_dir": glyph_dir, "packed_dir": packed_dir})]
+    output = subprocess.check_output(args, cwd=root)
+    return json.loads(output.decode())
+
+
+def _benchmark_text(length):
+    rng = random.Random(0)
+    words = []
+    while sum(len(word) + 1 for word in words) < length:
+        words.append("".join(rng.choice(BENCHMARK_CHARACTERS) for _ in range(rng.randint(1, 5))))
+    return " ".join(words)[:length]
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the page generator")
+    parser.add_argument("--output", help="path to write JSON results to (stdout if not specified)")
+    parser.add_argument("--pages", type=int, default=20, help="pages per run")
+    parser.add_argument("--variants", type=int, default=4, help="synthetic glyph variants")
+    parser.add_argument("--page-size", default="1000", help="comma-separated GLOBAL_WIDTH/HEIGHT values")
+    parser.add_argument("--cw", default="35", help="comma-separated GLOBAL_CW_WIDTH/HEIGHT values")
+    parser.add_argument("--workers", default="1", help="comma-separated worker counts")
+    parser.add_argument("--compositor", default="canvas", choices=["canvas", "concat"])
+    parser.add_argument("--glyph-dir", help="use an existing glyph set instead of a synthetic one")
+    parser.add_argument("--run-config", help=argparse.SUPPRESS)  # used by _run_isolated
+    args = parser.parse_args()
+
+    if args.run_config:
+        run = json.loads(args.run_config)
+        print(json.dumps(benchmark_config(run["config"], run["glyph_dir"], run["packed_dir"])))
+        return
+
+    def parse_list(value):
+        return [int(v) for v in value.split(",")]
+
+    results = run_benchmarks(parse_list(args.page_size), parse_list(args.cw), parse_list(args.workers),
+                             pages=args.pages, variants=args.variants, compositor=args.compositor,
+                             glyph_dir=args.glyph_dir)
+    report = {"commit": _git_commit(), "python": sys.version.split()[0], "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
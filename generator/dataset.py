@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-memory dataset API that synthesizes pages on the fly, e.g., inside a training data loader
+"""
+
+import itertools
+import random
+from typing import Dict, Iterator, List, Tuple, Union
+
+import numpy as np
+
+from data.corpus import Corpus
+from data.glyph import BaseGlyphLoader
+from generator.batch import GlyphStore, render_pages
+from generator.generator import get_characters_per_page, layout_page
+
+
+class PageDataset:
+    """
+    Iterable of (image, text) samples, where image is a (H, W) uint8 array and text is the page
+    text with linebreaks. Each sample renders a random page-sized window of a random text in a
+    random glyph variant.
+
+    Sample i is generated from a seed derived from (seed, i), so the samples don't depend on how
+    they are split across workers. Worker k of n yields samples k, k + n, k + 2n, ...
+
+    Usage with a PyTorch DataLoader (worker id and count are detected automatically):
+        dataset = PageDataset(gl, loader.load_data(corpus_dir), length=10000)
+        loader = DataLoader(dataset, batch_size=None, num_workers=4)
+    """
+
+    def __init__(self, gl: BaseGlyphLoader, texts: Union[Dict[str, str], List[str], Corpus], length=None, seed=0,
+                 characters_per_page=None, variants=None, worker_id=None, num_workers=None, batch_size=8,
+                 store: GlyphStore = None):
+        """
+        :param gl:
+        :param texts: { key: text } (e.g., from TextLoader.load_data), list of texts, or a Corpus
+        (windows are then drawn with `Corpus.sample_window`)
+        :param length: total number of samples (across all workers). Infinite if None.
+        :param seed: base seed
+        :param characters_per_page: max characters per page (see `get_characters_per_page` if None)
+        :param variants: glyph variants to sample from (all if None)
+        :param worker_id: index of this worker (from torch.utils.data.get_worker_info() if None)
+        :param num_workers: total number of workers (from torch.utils.data.get_worker_info() if None)
+        :param batch_size: number of pages rendered together (see `render_pages`)
+        :param store: prebuilt GlyphStore. Built from `gl` on first iteration if None.
+        """
+        self.gl = gl
+        if isinstance(texts, Corpus):
+            self.corpus = texts
+            self.texts = None
+        else:
+            self.corpus = None
+            self.texts = list(texts.values()) if isinstance(texts, dict) else list(texts)
+        self.length = length
+        self.seed = seed
+        self.characters_per_page = characters_per_page or get_characters_per_page()
+        self.variants = list(variants) if variants is not None else list(range(gl.variants))
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.store = store
+
+    def __len__(self):
+        if self.length is None:
+            raise TypeError("PageDataset has no length (infinite)")
+        return self.length
+
+    def __iter__(self) -> Iterator[Tuple[np.ndarray, str]]:
+        if self.store is None:
+            characters = set(itertools.chain.from_iterable(self.texts)) if self.texts is not None else None
+            self.store = GlyphStore(self.gl, characters=characters)
+
+        worker_id, num_workers = self._get_worker()
+        if self.length is None:
+            indices = itertools.count(worker_id, num_workers)
+        else:
+            indices = iter(range(worker_id, self.length, num_workers))
+        while True:
+            batch = list(itertools.islice(indices, self.batch_size))
+            if not batch:
+                return
+            layouts = [self.layout_sample(index) for index in batch]
+            pages = render_pages(self.store, layouts)
+            for page, layout in zip(pages, layouts):
+                yield page, "\n".join(layout.lines)
+
+    def layout_sample(self, index):
+        """
+        :return: PageLayout of sample `index`
+        """
+        rng = random.Random("{}:{}".format(self.seed, index))
+        variant = self.variants[rng.randrange(len(self.variants))]
+        if self.corpus is not None:
+            _, _, text = self.corpus.sample_window(self.characters_per_page, rng)
+            return layout_page(text, variant, rng)
+
+        text = self.texts[rng.randrange(len(self.texts))]
+        if len(text) > self.characters_per_page:
+            offset = rng.randint(0, len(text) - self.characters_per_page)
+            text = text[offset:offset + self.characters_per_page]
+        return layout_page(text, variant, rng)
+
+    def _get_worker(self):
+        worker_id, num_workers = self.worker_id, self.num_workers
+        if worker_id is None or num_workers is None:
+            try:
+                from torch.utils.data import get_worker_info
+                info = get_worker_info()
+            except ImportError:
+                info = None
+            if info is not None:
+                worker_id, num_workers = info.id, info.num_workers
+        return worker_id or 0, num_workers or 1
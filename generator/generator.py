@@ -4,19 +4,29 @@
 Script for generating full page text images
 """
 
+import hashlib
 import itertools
+import json
+import math
 import os
 import random
 import sys
+import time
+import weakref
+from collections import OrderedDict
 from multiprocessing import Pool
-from typing import Tuple, List
+from contextlib import ExitStack
+from typing import Dict, Tuple, List, NamedTuple
 
 import tqdm
 from PIL import Image, ImageChops
-from tqdm.contrib.concurrent import process_map
 
-from data.glyph import GlyphLoader
+from data.glyph import (BaseGlyphLoader, GlyphLoader, PackedGlyphLoader, PACKED_INDEX_FILENAME, SPECIAL_CHARACTERS,
+                        share_glyphs)
+from data import stats
 from data.text import TextLoader
+from generator.shards import ShardWriter, image_format_for_mode
+from generator.writer import PageWriter
 
 MAX_WORKERS = 8
 GLOBAL_CW_HEIGHT = 35  # character height and width
@@ -29,25 +39,151 @@ GLOBAL_WIDTH = 1000
 GLOBAL_HEIGHT = 1000
 GLOBAL_MAX_ROTATION = 10
 GLOBAL_LINE_HEIGHT = 30
-SPECIAL_CHARACTERS = ['.', ',', '?', ';', '!', '"', '\'', '/', '\'', '~', '@', '#', '%', '^', '&', '*', '(', ')', '-',
-                      '+', '>', '<', '[', ']', '{', '}', '₩']
+GLOBAL_ROTATION_BUCKETS = None  # if set, quantize glyph rotation into this many angles and cache rotated glyphs
+ROTATION_CACHE_SIZE = 50000  # max rotated glyphs cached per glyph loader (when GLOBAL_ROTATION_BUCKETS is set)
 
+GLYPH_DIR = "/Users/itsnamgyu/code/calligram/input/glyph/hicau_mod0/"
+PACKED_GLYPH_DIR = "/Users/itsnamgyu/code/calligram/input/glyph/hicau_mod0_packed/"  # used if it exists
 OUTPUT_DIR = "/Users/itsnamgyu/code/calligram/output/generator_test"
+OUTPUT_SHARDS = False  # write tar shards (see generator/shards.py) instead of .jpg/.txt files per page
+SHARD_SIZE = 1000  # pages per shard
+STATS_PATH = None  # if set, write run statistics here (JSON, or Prometheus text if it ends with .prom)
+STATS_INTERVAL = 30  # seconds between statistics dumps during a run
+GLOBAL_PIXEL_MODE = "L"  # "L" (grayscale), "1" (bilevel, saved as PNG) or "RGB"
+GLOBAL_OUTPUT_SCALES = None  # e.g., [1, 20 / 35]: write every page at these scales (<= 1), from a single render
+JOB_SEED = 0  # seed of a resumable job (see run_job); page seeds are derived from it
+JOB_CHUNK_SIZE = 100  # pages per chunk of a resumable job
+JOB_MANIFEST_FILENAME = "job.json"
+
+
+class GlyphPlacement(NamedTuple):
+    character: str
+    x: int  # top-left corner on the page
+    y: int
+    width: int  # size of the rotated glyph on the page
+    height: int
+    rotation: float
+
+
+class PageLayout(NamedTuple):
+    size: Tuple[int, int]  # (width, height) of the page
+    variant: int
+    placements: List[GlyphPlacement]
+    lines: List[str]
+
+
+class RotationBank:
+    """
+    Bounded LRU cache of rotated and resized glyphs. Rotations are quantized into `buckets` angles
+    in [-GLOBAL_MAX_ROTATION, GLOBAL_MAX_ROTATION], trading augmentation variety for throughput.
+    """
+
+    def __init__(self, gl: BaseGlyphLoader, buckets, max_entries=ROTATION_CACHE_SIZE):
+        """
+        :param gl:
+        :param buckets: number of distinct rotation angles
+        :param max_entries: max number of cached glyphs
+        """
+        self.gl = gl
+        self.buckets = buckets
+        self.max_entries = max_entries
+        self.cache = OrderedDict()  # { (character, variant, rotation, size): Image }
+
+    def quantize(self, rotation):
+        return quantize_rotation(rotation, self.buckets)
+
+    def get(self, character, variant, rotation, size) -> Image.Image:
+        """
+        :param character:
+        :param variant:
+        :param rotation: rotation in degrees (quantized to the nearest bucket)
+        :param size: (width, height) of the rotated glyph
+        :return: grayscale ("L") image
+        """
+        key = (character, variant, self.quantize(rotation), tuple(size))
+        img = self.cache.get(key)
+        if img is not None:
+            stats.increment("rotation_bank.hits")
+            self.cache.move_to_end(key)
+            return img
+
+        stats.increment("rotation_bank.misses")
+        img = self.gl.load_normalized_glyph(character, variant, (GLOBAL_CW_WIDTH, GLOBAL_CW_HEIGHT),
+                                            trim=character not in SPECIAL_CHARACTERS)
+        img = img.rotate(key[2], resample=Image.BICUBIC, fillcolor=255, expand=True)
+        img = img.resize(key[3], Image.BICUBIC)
+        self.cache[key] = img
+        if len(self.cache) > self.max_entries:
+            stats.increment("rotation_bank.evictions")
+            self.cache.popitem(last=False)
+        return img
+
+
+_rotation_banks = weakref.WeakKeyDictionary()  # { loader: RotationBank }
+
+
+def get_rotation_bank(gl: BaseGlyphLoader):
+    """
+    :return: the RotationBank for `gl` if GLOBAL_ROTATION_BUCKETS is set, otherwise None
+    """
+    if not GLOBAL_ROTATION_BUCKETS:
+        return None
+    bank = _rotation_banks.get(gl)
+    if bank is None or bank.buckets != GLOBAL_ROTATION_BUCKETS:
+        bank = RotationBank(gl, GLOBAL_ROTATION_BUCKETS)
+        _rotation_banks[gl] = bank
+    return bank
 
 
-def generate_page_data(gl: GlyphLoader, text, variant, output_path=None, character_per_page=2000) -> Tuple[
-    Image.Image, str]:
+def quantize_rotation(rotation, buckets):
+    """
+    Snaps a rotation to the nearest of `buckets` evenly spaced angles in
+    [-GLOBAL_MAX_ROTATION, GLOBAL_MAX_ROTATION].
+    """
+    if buckets <= 1:
+        return 0.0
+    step = 2 * GLOBAL_MAX_ROTATION / (buckets - 1)
+    index = round((rotation + GLOBAL_MAX_ROTATION) / step)
+    return -GLOBAL_MAX_ROTATION + min(max(index, 0), buckets - 1) * step
+
+
+def generate_page_data(gl: BaseGlyphLoader, text, variant, output_path=None, character_per_page=2000,
+                       compositor="canvas", mode=None) -> Tuple[Image.Image, str]:
     """
     :param gl:
     :param text: text to print out on the page
     :param output_path: path to save the generated image data if specified.
     :param variant: glyph variant
+    :param compositor: "canvas" to lay out the page first and paste all glyphs onto a single canvas
+    (see `layout_page`), or "concat" to build the page by concatenating glyphs and lines
+    :param mode: pixel mode of the page, "L", "1" or "RGB" (GLOBAL_PIXEL_MODE if None). Pages are
+    rendered in grayscale and thresholded at the end for "1".
     :return: Image, text (with linebreaks)
     """
+    mode = GLOBAL_PIXEL_MODE if mode is None else mode
+    if mode not in ("L", "1", "RGB"):
+        raise ValueError("Invalid mode: {}".format(mode))
+
+    if compositor == "canvas":
+        with stats.timer("page.layout"):
+            layout = layout_page(text, variant)
+        with stats.timer("page.composite"):
+            page = composite_page(gl, layout, mode)
+        stats.increment("pages.rendered")
+        stats.increment("glyphs.rendered", len(layout.placements))
+        if output_path:
+            with stats.timer("page.save"):
+                page.save(output_path)
+        return page, "\n".join(layout.lines)
+    elif compositor != "concat":
+        raise ValueError("Invalid compositor: {}".format(compositor))
+
     y = 0
     CHARACTERS_PER_LINE = int((GLOBAL_WIDTH / GLOBAL_CW_WIDTH)) - 1
-    page = Image.new('RGB', (GLOBAL_WIDTH + 2 * GLOBAL_MARGIN_WIDTH, GLOBAL_HEIGHT + 2 * GLOBAL_MARGIN_HEIGHT), "WHITE")
-    dst = Image.new('RGB', (GLOBAL_WIDTH, GLOBAL_MARGIN_HEIGHT), "WHITE")
+    raster_mode = _raster_mode(mode)
+    page = Image.new(raster_mode, (GLOBAL_WIDTH + 2 * GLOBAL_MARGIN_WIDTH, GLOBAL_HEIGHT + 2 * GLOBAL_MARGIN_HEIGHT),
+                     "WHITE")
+    dst = Image.new(raster_mode, (GLOBAL_WIDTH, GLOBAL_MARGIN_HEIGHT), "WHITE")
     left = (character_per_page - len(text)) / CHARACTERS_PER_LINE
 
     lines = []
@@ -55,7 +191,7 @@ def generate_page_data(gl: GlyphLoader, text, variant, output_path=None, charact
         lines.append(text[i:i + CHARACTERS_PER_LINE])
 
     for line in lines:
-        im = generate_single_line(gl, line, 0, y, CHARACTERS_PER_LINE, variant)
+        im = generate_single_line(gl, line, 0, y, CHARACTERS_PER_LINE, variant, raster_mode)
         dst = get_concat_v_resize(dst, im)
         y = y + GLOBAL_CW_HEIGHT
 
@@ -65,6 +201,7 @@ def generate_page_data(gl: GlyphLoader, text, variant, output_path=None, charact
         dst = get_concat_v_resize(dst, Image.new('RGB', (GLOBAL_WIDTH, GLOBAL_HEIGHT - y), "WHITE"), True, True)
     """
     page.paste(dst, (GLOBAL_MARGIN_WIDTH, GLOBAL_MARGIN_HEIGHT))
+    page = _convert_page(page, mode)
     if output_path:
         page.save(output_path)
 
@@ -73,7 +210,7 @@ def generate_page_data(gl: GlyphLoader, text, variant, output_path=None, charact
     return page, text
 
 
-def generate_single_line(gl: GlyphLoader, text, start_x, start_y, size, variant):
+def generate_single_line(gl: BaseGlyphLoader, text, start_x, start_y, size, variant, mode="L"):
     """
     print out a single line of images 
         :param : 
@@ -81,32 +218,203 @@ def generate_single_line(gl: GlyphLoader, text, start_x, start_y, size, variant)
             start_x, start_y : position of the starting character 
             end_x, end_y : position of the last character
             variant : glyph variant
+            mode : pixel mode of the line, "L" or "RGB"
     """
     previous_x = start_x + GLOBAL_MARGIN_WIDTH
     previous_y = start_y + GLOBAL_MARGIN_HEIGHT
     previous_rotation = 0
     i = 0
-    dst = Image.new("RGB", (GLOBAL_MARGIN_WIDTH, GLOBAL_CW_HEIGHT), "white")
+    dst = Image.new(mode, (GLOBAL_MARGIN_WIDTH, GLOBAL_CW_HEIGHT), "white")
     text = text.lstrip()
     text += ' ' * (size - len(text))
     for c in text:
         if c.isspace():
-            img = Image.new("RGB", (GLOBAL_CW_WIDTH, GLOBAL_CW_HEIGHT), "white")
+            img = Image.new(mode, (GLOBAL_CW_WIDTH, GLOBAL_CW_HEIGHT), "white")
             dst = get_concat_h_resize(dst, img, True, False)
-        elif c in SPECIAL_CHARACTERS:
-            img = gl.load_glyph(c, variant).convert("RGB")
-            img.resize((GLOBAL_CW_WIDTH, GLOBAL_CW_HEIGHT), Image.ANTIALIAS)
-            dst = get_concat_h_resize(dst, img, True, True)
         else:
-            img = trim(gl.load_glyph(c, variant)).convert("RGB")
-            img.resize((GLOBAL_CW_WIDTH, GLOBAL_CW_HEIGHT), Image.ANTIALIAS)
+            # Trimmed (except for special characters) and resized once per glyph by the loader
+            img = gl.load_normalized_glyph(c, variant, (GLOBAL_CW_WIDTH, GLOBAL_CW_HEIGHT),
+                                           trim=c not in SPECIAL_CHARACTERS).convert(mode)
             dst = get_concat_h_resize(dst, img, True, True)
         previous_x, previous_y, previous_rotation = calculate_next_position(previous_x, previous_y, previous_rotation)
         i = i + 1
-    dst = get_concat_h_resize(dst, Image.new("RGB", (GLOBAL_MARGIN_WIDTH, GLOBAL_CW_HEIGHT), "white"), True, False)
+    dst = get_concat_h_resize(dst, Image.new(mode, (GLOBAL_MARGIN_WIDTH, GLOBAL_CW_HEIGHT), "white"), True, False)
     return dst
 
 
+def layout_page(text, variant, rng=random) -> PageLayout:
+    """
+    Computes where each glyph goes on the page, following the same rules as the "concat"
+    compositor: each line is a left margin, one cell per character and a right margin, scaled to
+    fit GLOBAL_WIDTH, with a random gap above each line and a random rotation for each glyph.
+
+    :param text: text to print out on the page
+    :param variant: glyph variant
+    :param rng: source of randomness, e.g., a seeded random.Random (global random module by default)
+    :return: PageLayout
+    """
+    characters_per_line = int((GLOBAL_WIDTH / GLOBAL_CW_WIDTH)) - 1
+    page_size = (GLOBAL_WIDTH + 2 * GLOBAL_MARGIN_WIDTH, GLOBAL_HEIGHT + 2 * GLOBAL_MARGIN_HEIGHT)
+
+    lines = []
+    for i in range(0, len(text), characters_per_line):
+        lines.append(text[i:i + characters_per_line])
+
+    placements = []
+    y = GLOBAL_MARGIN_HEIGHT * 2  # page margin + blank strip at the top of the text block
+    for line in lines:
+        line = line.lstrip()
+        line += ' ' * (characters_per_line - len(line))
+
+        # Cell widths in line coordinates, where each line is GLOBAL_CW_HEIGHT tall
+        cells = []
+        for c in line:
+            if c.isspace():
+                cells.append((c, GLOBAL_CW_WIDTH, 0))
+            else:
+                rotation = GLOBAL_MAX_ROTATION * rng.uniform(-1, 1)
+                if GLOBAL_ROTATION_BUCKETS:
+                    rotation = quantize_rotation(rotation, GLOBAL_ROTATION_BUCKETS)
+                width, height = _rotated_size(GLOBAL_CW_WIDTH, GLOBAL_CW_HEIGHT, rotation)
+                cells.append((c, width * GLOBAL_CW_HEIGHT / height, rotation))
+
+        y += int(GLOBAL_LINE_HEIGHT * rng.uniform(0.3, 1))
+        scale = GLOBAL_WIDTH / (2 * GLOBAL_MARGIN_WIDTH + sum(width for _, width, _ in cells))
+        line_height = int(GLOBAL_CW_HEIGHT * scale)
+        x = GLOBAL_MARGIN_WIDTH + GLOBAL_MARGIN_WIDTH * scale
+        for c, width, rotation in cells:
+            if not c.isspace():
+                placements.append(GlyphPlacement(c, int(round(x)), y, max(1, int(round(width * scale))),
+                                                 line_height, rotation))
+            x += width * scale
+        y += line_height
+
+    return PageLayout(page_size, variant, placements, lines)
+
+
+def composite_page(gl: BaseGlyphLoader, layout: PageLayout, mode="L") -> Image.Image:
+    """
+    Renders a PageLayout by pasting each glyph directly onto a single page canvas. Glyphs that fall
+    off the bottom of the page are clipped. Rotated glyphs come from the loader's RotationBank if
+    GLOBAL_ROTATION_BUCKETS is set.
+
+    :param gl:
+    :param layout: PageLayout from `layout_page`
+    :param mode: pixel mode of the page, "L", "1" or "RGB"
+    :return: Image
+    """
+    page = Image.new(_raster_mode(mode), layout.size, "WHITE")
+    bank = get_rotation_bank(gl)
+    for p in layout.placements:
+        if p.y >= layout.size[1]:
+            break
+        if bank:
+            page.paste(bank.get(p.character, layout.variant, p.rotation, (p.width, p.height)), (p.x, p.y))
+            continue
+        img = gl.load_normalized_glyph(p.character, layout.variant, (GLOBAL_CW_WIDTH, GLOBAL_CW_HEIGHT),
+                                       trim=p.character not in SPECIAL_CHARACTERS)
+        img = img.rotate(p.rotation, resample=Image.BICUBIC, fillcolor=255, expand=True)
+        page.paste(img.resize((p.width, p.height), Image.BICUBIC), (p.x, p.y))
+    return _convert_page(page, mode)
+
+
+def generate_page_scales(gl: BaseGlyphLoader, text, variant, scales, mode=None) -> Tuple[Dict[float, Image.Image], str]:
+    """
+    Renders a page once at full resolution and downsamples it to each scale, so that the outputs at
+    all scales share the same layout and text.
+
+    :param gl:
+    :param text: text to print out on the page
+    :param variant: glyph variant
+    :param scales: scales in (0, 1], relative to the GLOBAL_* page and glyph sizes
+    :param mode: pixel mode, see `generate_page_data`
+    :return: { scale: Image }, text (with linebreaks)
+    """
+    with stats.timer("page.layout"):
+        layout = layout_page(text, variant)
+    pages = render_page_scales(gl, layout, scales, mode)
+    return pages, "\n".join(layout.lines)
+
+
+def render_page_scales(gl: BaseGlyphLoader, layout: PageLayout, scales, mode=None) -> Dict[float, Image.Image]:
+    """
+    :param gl:
+    :param layout: PageLayout from `layout_page`
+    :param scales: scales in (0, 1]
+    :param mode: pixel mode, see `generate_page_data`
+    :return: { scale: Image }
+    """
+    mode = GLOBAL_PIXEL_MODE if mode is None else mode
+    with stats.timer("page.composite"):
+        page = composite_page(gl, layout, _raster_mode(mode))
+    stats.increment("pages.rendered")
+    stats.increment("glyphs.rendered", len(layout.placements))
+    pages = {}
+    for scale in scales:
+        with stats.timer("page.downsample"):
+            pages[scale] = _convert_page(downsample_page(page, scale), mode)
+    return pages
+
+
+def downsample_page(page: Image.Image, scale) -> Image.Image:
+    """
+    Area-downsamples a page, i.e., each output pixel is the mean of the pixels it covers, so thin
+    strokes fade instead of breaking up as they do with point sampling.
+
+    :param page: grayscale or RGB page
+    :param scale: scale in (0, 1]
+    :return: Image
+    """
+    if not 0 < scale <= 1:
+        raise ValueError("Invalid scale (must be in (0, 1]): {}".format(scale))
+    if scale == 1:
+        return page
+    factor = 1 / scale
+    if abs(factor - round(factor)) < 1e-6:
+        return page.reduce(int(round(factor)))
+    return page.resize((max(1, round(page.width * scale)), max(1, round(page.height * scale))), Image.BOX)
+
+
+def scale_dir_name(scale):
+    """
+    :return: name of the subdirectory of the output directory for pages at `scale`
+    """
+    return "scale_{:.3g}".format(scale)
+
+
+def _raster_mode(mode):
+    """
+    Mode to draw a page in before converting it to `mode`. Bilevel images can't be resampled, so
+    "1" pages are drawn in grayscale.
+    """
+    return "RGB" if mode == "RGB" else "L"
+
+
+def _convert_page(page, mode):
+    if page.mode == mode:
+        return page
+    if mode == "1":
+        return page.convert("1", dither=Image.NONE)  # threshold at 128 instead of dithering
+    return page.convert(mode)
+
+
+def get_characters_per_page():
+    """
+    :return: number of characters that fit on a page with the current GLOBAL_* settings
+    """
+    characters_per_line = int((GLOBAL_WIDTH / GLOBAL_CW_WIDTH)) - 1
+    return int((GLOBAL_HEIGHT / (GLOBAL_CW_HEIGHT + GLOBAL_LINE_HEIGHT))) * characters_per_line
+
+
+def _rotated_size(width, height, rotation):
+    """
+    Size of the bounding box of a width x height image rotated by `rotation` degrees.
+    """
+    theta = math.radians(rotation)
+    cos, sin = abs(math.cos(theta)), abs(math.sin(theta))
+    return width * cos + height * sin, width * sin + height * cos
+
+
 def calculate_next_position(previous_x, previous_y, previous_rotation):
     """
      Returns the x,y position of the next character to be printed.
@@ -125,8 +433,6 @@ def get_concat_h_resize(im1, im2, resample=Image.BICUBIC, resize_big_image=True,
     if rotate_image:
         ro = GLOBAL_MAX_ROTATION * random.uniform(-1, 1)
         im2 = im2.rotate(ro, fillcolor='WHITE', expand=True)
-    if resize_big_image:
-        im2.resize((GLOBAL_CW_WIDTH, GLOBAL_CW_HEIGHT), Image.ANTIALIAS)
 
     if im1.height == im2.height:
         _im1 = im1
@@ -138,7 +444,7 @@ def get_concat_h_resize(im1, im2, resample=Image.BICUBIC, resize_big_image=True,
     else:
         _im1 = im1
         _im2 = im2.resize((int(im2.width * im1.height / im2.height), im1.height), resample=resample)
-    dst = Image.new('RGB', (_im1.width + _im2.width, _im1.height), "WHITE")
+    dst = Image.new(_im1.mode, (_im1.width + _im2.width, _im1.height), "WHITE")
 
     dst.paste(_im1, (0, 0))
     dst.paste(_im2, (_im1.width, 0))
@@ -171,37 +477,270 @@ def get_concat_v_resize(im1, im2, resample=Image.BICUBIC, resize_big_image=True,
 
     if not isEmpty:
         GAP = int(GLOBAL_LINE_HEIGHT * random.uniform(0.3, 1))
-        dst = Image.new("RGB", (_im1.width, _im1.height + _im2.height + GAP))
+        dst = Image.new(_im1.mode, (_im1.width, _im1.height + _im2.height + GAP))
         dst.paste(_im1, (0, 0))
-        dst.paste(Image.new("RGB", (_im1.width, GAP), "white"), (0, _im1.height))
+        dst.paste(Image.new(_im1.mode, (_im1.width, GAP), "white"), (0, _im1.height))
         dst.paste(_im2, (0, _im1.height + GAP))
     else:
-        dst = Image.new("RGB", (_im1.width, _im1.height + _im2.height))
+        dst = Image.new(_im1.mode, (_im1.width, _im1.height + _im2.height))
         dst.paste(_im1, (0, 0))
         dst.paste(_im2, (0, _im1.height))
 
     return dst
 
 
-def _generate_data(item):
-    i, (variant, data, characters_per_page, gl) = item
-    key, string = data
+def _select_page_text(string, characters_per_page, rng=random):
+    """
+    :param rng: source of randomness for the offset, e.g., a random.Random seeded with the page seed
+    :return: offset, page-sized window of `string` starting at offset
+    """
     if len(string) > characters_per_page:
         # For strings that may be longer than characters_per_page
-        offset = random.randint(0, len(string) - characters_per_page)
-        offset = 0
+        offset = rng.randint(0, len(string) - characters_per_page)
         string = string[offset: offset + characters_per_page]
     else:
         offset = 0
-    output_image_path = os.path.join(OUTPUT_DIR, "text{:04d}_{}_{:04d}_{:06d}.jpg".format(i, key, variant, offset))
-    output_text_path = os.path.join(OUTPUT_DIR, "text{:04d}_{}_{:04d}_{:06d}.txt".format(i, key, variant, offset))
-    image, text = generate_page_data(gl, string, variant, output_image_path, characters_per_page)
-    with open(output_text_path, "w") as f:
-        f.write(text)
+    return offset, string
+
+
+def _page_name(i, key, variant, offset):
+    return "text{:04d}_{}_{:04d}_{:06d}".format(i, key, variant, offset)
+
+
+def _write_page_data(gl, i, key, variant, offset, string, characters_per_page, output_dir=None, writer=None):
+    """
+    Generates a page and writes it with `writer` (a PageWriter), or synchronously to `output_dir`
+    (OUTPUT_DIR if None) if `writer` is None. With GLOBAL_OUTPUT_SCALES, each scale is written to
+    its own subdirectory (see `_make_output_dirs`).
+    """
+    pages, text = _generate_page_outputs(gl, string, variant, characters_per_page)
+    name = _page_name(i, key, variant, offset)
+    if writer is None:
+        with PageWriter(OUTPUT_DIR if output_dir is None else output_dir, threads=0) as writer:
+            for subdir, image in pages:
+                writer.write(os.path.join(subdir, name), image, text)
+    else:
+        for subdir, image in pages:
+            writer.write(os.path.join(subdir, name), image, text)
+
+
+def _generate_page_outputs(gl, string, variant, characters_per_page):
+    """
+    :return: [(output subdirectory, Image)], text. A single page in the output directory itself,
+    unless GLOBAL_OUTPUT_SCALES is set.
+    """
+    if GLOBAL_OUTPUT_SCALES:
+        pages, text = generate_page_scales(gl, string, variant, GLOBAL_OUTPUT_SCALES)
+        return [(scale_dir_name(scale), page) for scale, page in pages.items()], text
+    image, text = generate_page_data(gl, string, variant, None, characters_per_page)
+    return [("", image)], text
+
+
+def _output_subdirs(scales):
+    return [scale_dir_name(scale) for scale in scales] if scales else [""]
+
+
+def _make_output_dirs(output_dir, scales=None):
+    for subdir in _output_subdirs(scales):
+        os.makedirs(os.path.join(output_dir, subdir), exist_ok=True)
+
+
+_worker_gl = None  # set in each worker process by _init_worker
+
+
+def _init_worker(gl, stats_enabled=False, settings=None):
+    """
+    :param settings: module settings from `_worker_settings`. Workers started with the "spawn"
+    method (the default on macOS) re-import this module and would otherwise use the defaults.
+    """
+    global _worker_gl
+    _worker_gl = gl
+    if settings:
+        globals().update(settings)
+    stats.enable(stats_enabled)
+    stats.clear()  # forked workers start with a copy of the parent's statistics
+
+
+def _worker_settings():
+    """
+    :return: { name: value } of the GLOBAL_* settings and OUTPUT_DIR, as currently set in this process
+    """
+    return {name: value for name, value in globals().items() if name.startswith("GLOBAL_") or name == "OUTPUT_DIR"}
+
+
+def _write_shard(shard_dir, shard_index, tasks):
+    """
+    Generates the pages of `tasks` into a single shard (one per scale with GLOBAL_OUTPUT_SCALES,
+    in the scale's subdirectory). Pages are encoded in the background while the next page is
+    rendered.
+    """
+    image_format = image_format_for_mode(GLOBAL_PIXEL_MODE)
+    with ExitStack() as stack:
+        writers = {}  # { subdir: PageWriter }
+        for subdir in _output_subdirs(GLOBAL_OUTPUT_SCALES):
+            shard = stack.enter_context(ShardWriter(os.path.join(shard_dir, subdir), max_records=len(tasks),
+                                                    start_index=shard_index, image_format=image_format))
+            writers[subdir] = stack.enter_context(PageWriter(shard_writer=shard))
+        for i, variant, key, offset, string, characters_per_page, seed in tasks:
+            random.seed(seed)
+            pages, text = _generate_page_outputs(_worker_gl, string, variant, characters_per_page)
+            metadata = {"key": key, "variant": variant, "offset": offset, "seed": seed}
+            for subdir, image in pages:
+                writers[subdir].write(_page_name(i, key, variant, offset), image, text, metadata)
+
+
+def derive_seed(job_seed, *identity):
+    """
+    Derives the seed of a single page from the job seed and the page's identity, e.g.,
+    (key, variant). The result doesn't depend on the order or process in which pages are
+    generated.
+
+    :return: 32-bit seed
+    """
+    return random.Random(":".join(str(part) for part in (job_seed,) + identity)).randrange(2 ** 32)
+
+
+def plan_job(all_data, variants, characters_per_page, seed=JOB_SEED, chunk_size=JOB_CHUNK_SIZE):
+    """
+    Plans a page for every (variant, text) pair and splits the pages into chunks of consecutive tasks.
+
+    :param all_data: { key: text }
+    :param variants: number of glyph variants
+    :param characters_per_page:
+    :param seed: job seed
+    :param chunk_size: pages per chunk
+    :return: list of chunks, each a list of (i, variant, key, offset, text, characters_per_page, seed)
+    """
+    tasks = []
+    for i, (variant, (key, string)) in enumerate(itertools.product(range(0, variants), all_data.items())):
+        page_seed = derive_seed(seed, key, variant)
+        offset, string = _select_page_text(string, characters_per_page, random.Random(page_seed))
+        tasks.append((i, variant, key, offset, string, characters_per_page, page_seed))
+    return [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+
+
+def _job_fingerprint(chunks, shards):
+    """
+    Hash of everything that determines the output of a job, so that a job is never resumed with
+    different texts or settings.
+    """
+    h = hashlib.sha1()
+    settings = [GLOBAL_CW_WIDTH, GLOBAL_CW_HEIGHT, GLOBAL_MARGIN_WIDTH, GLOBAL_MARGIN_HEIGHT, GLOBAL_WIDTH,
+                GLOBAL_HEIGHT, GLOBAL_MAX_ROTATION, GLOBAL_LINE_HEIGHT, GLOBAL_ROTATION_BUCKETS, GLOBAL_PIXEL_MODE,
+                GLOBAL_OUTPUT_SCALES, shards]
+    h.update(json.dumps(settings).encode("utf-8"))
+    for chunk in chunks:
+        h.update(b"\x00")  # chunk boundary
+        for task in chunk:
+            h.update(json.dumps(task, ensure_ascii=False).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _read_job_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_job_manifest(path, manifest):
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def _generate_chunk_task(item):
+    chunk_index, (output_dir, shards, tasks) = item
+    if shards:
+        _write_shard(output_dir, chunk_index, tasks)
+    else:
+        with PageWriter(output_dir) as writer:
+            for i, variant, key, offset, string, characters_per_page, seed in tasks:
+                random.seed(seed)
+                _write_page_data(_worker_gl, i, key, variant, offset, string, characters_per_page, writer=writer)
+    return chunk_index, len(tasks), stats.snapshot(reset=True) if stats.is_enabled() else None
+
+
+def run_job(gl: BaseGlyphLoader, all_data, output_dir, characters_per_page, seed=JOB_SEED, chunk_size=JOB_CHUNK_SIZE,
+            max_workers=MAX_WORKERS, shards=False, stats_path=STATS_PATH, stats_interval=STATS_INTERVAL):
+    """
+    Generates a page for every (variant, text) pair using a process pool. All pages are planned up
+    front and split into chunks of `chunk_size` pages, and each chunk is a single task for the pool.
+    Glyphs are copied into shared memory once and handed to each worker when it starts, so tasks
+    only carry the page text and memory use doesn't grow with the number of workers. Every page is
+    generated from its own seed derived from `seed` (see `derive_seed`), so the output is the same
+    for any number of workers. Completed chunks are recorded in <output_dir>/JOB_MANIFEST_FILENAME;
+    running the same job again skips them, and chunks that were interrupted are regenerated from
+    scratch under the same names.
+
+    :param gl:
+    :param all_data: { key: text }
+    :param output_dir: directory for pages (and the job manifest)
+    :param characters_per_page:
+    :param seed: job seed
+    :param chunk_size: pages per chunk (and per shard, if `shards`)
+    :param max_workers:
+    :param shards: write each chunk as a tar shard (see generator/shards.py) instead of .jpg/.txt files
+    :param stats_path: if specified, collect statistics from all workers and write them here every
+    `stats_interval` seconds and at the end of the run (see data/stats.py)
+    :param stats_interval:
+    :return: number of pages generated by this call
+    """
+    _make_output_dirs(output_dir, GLOBAL_OUTPUT_SCALES)
+    chunks = plan_job(all_data, gl.variants, characters_per_page, seed, chunk_size)
+    manifest_path = os.path.join(output_dir, JOB_MANIFEST_FILENAME)
+    fingerprint = _job_fingerprint(chunks, shards)
+    manifest = _read_job_manifest(manifest_path)
+    if manifest is None:
+        manifest = {"fingerprint": fingerprint, "seed": seed, "chunk_size": chunk_size, "chunks": len(chunks),
+                    "pages": sum(len(chunk) for chunk in chunks), "completed": []}
+        _write_job_manifest(manifest_path, manifest)
+    elif manifest["fingerprint"] != fingerprint:
+        raise ValueError("{} belongs to a different job (texts, seed or settings changed)".format(manifest_path))
+
+    completed = set(manifest["completed"])
+    pending = [(index, (output_dir, shards, chunk)) for index, chunk in enumerate(chunks) if index not in completed]
+    if not pending:
+        return 0
+
+    if stats_path:
+        stats.enable()
+    with stats.timer("glyph.share"):
+        shared = share_glyphs(gl, normalized_size=(GLOBAL_CW_WIDTH, GLOBAL_CW_HEIGHT))
+    generated = 0
+    try:
+        worker_stats = []
+        last_dump = time.monotonic()
+        with Pool(min(max_workers, len(pending)), initializer=_init_worker,
+                  initargs=(shared, stats.is_enabled(), _worker_settings())) as pool:
+            remaining = sum(len(chunk) for _, (_, _, chunk) in pending)
+            with tqdm.tqdm(total=manifest["pages"], initial=manifest["pages"] - remaining) as progress:
+                for chunk_index, pages, snapshot in pool.imap_unordered(_generate_chunk_task, pending):
+                    completed.add(chunk_index)
+                    manifest["completed"] = sorted(completed)
+                    _write_job_manifest(manifest_path, manifest)
+                    generated += pages
+                    progress.update(pages)
+                    if snapshot:
+                        worker_stats = [stats.merge(worker_stats + [snapshot])]
+                    if stats_path and time.monotonic() - last_dump >= stats_interval:
+                        stats.dump(stats.merge(worker_stats + [stats.snapshot()]), stats_path)
+                        last_dump = time.monotonic()
+        if stats_path:
+            stats.dump(stats.merge(worker_stats + [stats.snapshot()]), stats_path)
+    finally:
+        shared.unlink()
+    return generated
 
 
 def main():
-    gl = GlyphLoader("/Users/itsnamgyu/code/calligram/input/glyph/hicau_mod0/", ext="tif")
+    if os.path.isfile(os.path.join(PACKED_GLYPH_DIR, PACKED_INDEX_FILENAME)):
+        # Copying a packed set into shared memory is much faster than decoding every TIFF
+        # (pack with `python -m data.glyph <glyph_dir> <packed_dir>`)
+        gl = PackedGlyphLoader(PACKED_GLYPH_DIR)
+    else:
+        gl = GlyphLoader(GLYPH_DIR, ext="tif")
     s = str(gl.character_set)[:1000]
     character_set = [' ']
     i = 0
@@ -218,18 +757,30 @@ def main():
                      '보', '둘', '옥', '머', '은', '한', '잠', '울', '내', '니', '자', '정', ',', '새', '시', '불', '케', '경', '당', '피',
                      '를', '리', '나', '쓸', '없', '과', '때', '추']
     loader = TextLoader(character_set)
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    characters_per_line = int((GLOBAL_WIDTH / GLOBAL_CW_WIDTH)) - 1
-    characters_per_page = int((GLOBAL_HEIGHT / (GLOBAL_CW_HEIGHT + GLOBAL_LINE_HEIGHT))) * characters_per_line
+    _make_output_dirs(OUTPUT_DIR, GLOBAL_OUTPUT_SCALES)
+    characters_per_page = get_characters_per_page()
     print("Characters per page:", characters_per_page)
 
     all_data = {}
 
     """
-    # Use random string
-    print("Loading random strings")
-    for i in tqdm.tqdm(range(0, 180)):
-        all_data[i] = loader.generate_random_text(max_length=int(characters_per_page * random.uniform(0.9, 1)))
+    # Use random strings (warm-up data for rare characters)
+    print("Generating random strings")
+    rng = random.Random(JOB_SEED)
+    lengths = [int(characters_per_page * rng.uniform(0.9, 1)) for _ in range(180)]
+    weights = None  # e.g., loader.inverse_frequency_weights(TextLoader.character_frequencies(corpus_texts))
+    texts = loader.generate_random_texts(len(lengths), lengths, weights=weights, coverage=True, seed=JOB_SEED)
+    all_data.update(enumerate(texts))
+    """
+
+    """
+    # Use preprocessed corpus (see data/corpus.py). Pages start at random words across the corpus.
+    from data.corpus import Corpus
+    print("Sampling pages from corpus")
+    corpus = Corpus("/Users/itsnamgyu/code/calligram/input/text/kaist_corpus_indexed")
+    for i in tqdm.tqdm(range(0, 1000)):
+        key, offset, text = corpus.sample_window(characters_per_page)
+        all_data["{}_{:06d}".format(key, offset)] = text
     """
 
     # Use poem data
@@ -237,19 +788,15 @@ def main():
     poem = "계절이 지나가는 하늘에는 가을로 가득 차 있습니다. 나는 아무 걱정도 없이 가을 속의 별들을 다 헬 듯합니다. 가슴 속에 하나 둘 새겨지는 별을 이제 다 못 헤는 것은 쉬이 아침이 오는 까닭이요, 내일 밤이 남은 까닭이요, 아직 나의 청춘이 다하지 않은 까닭입니다. 별 하나에 추억과 별 하나에 사랑과 별 하나에 쓸쓸함과 별 하나에 동경과 별 하나에 시와 별 하나에 어머니, 어머니, 어머님, 나는 별 하나에 아름다운 말 한마디씩 불러 봅니다. 소학교 때 책상을 같이 했던 아이들의 이름과, 패, 경, 옥, 이런 이국 소녀들의 이름과, 벌써 아기 어머니 된 계집애들의 이름과, 가난한 이웃 사람들의 이름과, 비둘기, 강아지, 토끼, 노새, 노루, 프랑시스 잠, 라이너 마리아 릴케 이런 시인의 이름을 불러 봅니다. 이네들은 너무나 멀리 있습니다. 별이 아스라이 멀듯이. 어머님, 그리고 당신은 멀리 북간도에 계십니다. 나는 무엇인지 그리워 이 많은 별빛이 내린 언덕 위에 내 이름자를 써 보고 흙으로 덮어 버리었습니다. 딴은 밤을 새워 우는 벌레는 부끄러운 이름을 슬퍼하는 까닭입니다. 그러나 겨울이 지나고 나의 별에도 봄이 오면 무덤 위에 파란 잔디가 피어나듯이 내 이름자 묻힌 언덕 위에도 자랑처럼 풀이 무성할 거외다."
     import random
     l = poem.split()
-    random.shuffle(l)
+    random.Random(JOB_SEED).shuffle(l)  # same text on every run, so that run_job can resume
     poem = ' '.join(l)
     all_data[0] = poem
 
-    items = itertools.product(range(0, gl.variants), all_data.items(), [characters_per_page], [gl])
-    total = gl.variants * len(all_data)
-
-    MAX_WORKERS = 8
     print("Generating pages for {} variants for {} strings using up to {} workers".format(gl.variants, len(all_data), MAX_WORKERS))
 
-    process_map(_generate_data, enumerate(items), max_workers=MAX_WORKERS, total=total)
-    p = Pool(MAX_WORKERS)
-    p.map(_generate_data, enumerate(items))
+    # Resumable: rerunning skips chunks that are already done
+    run_job(gl, all_data, OUTPUT_DIR, characters_per_page, seed=JOB_SEED, max_workers=MAX_WORKERS,
+            shards=OUTPUT_SHARDS)
     """
     for i, (variant, data) in tqdm.tqdm(, total=total):
         key, string = data
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+"""
+Staged page generation pipeline. Each stage runs on its own threads (or, for rasterization, a
+process pool) and passes pages to the next stage through a bounded queue:
+
+    sample -> layout -> raster -> encode -> sink
+
+A stage blocks when the queue to the next stage is full, so a slow stage (e.g., a slow disk in
+the sink) throttles the stages before it instead of letting pages pile up in memory.
+
+Usage:
+    pipeline = Pipeline(gl, output_dir="<output_dir>", raster_processes=4)
+    pipeline.run(loader.iter_data("<corpus_dir>"), get_characters_per_page())
+"""
+
+import multiprocessing
+import os
+import queue
+import random
+import threading
+import time
+
+import tqdm
+
+from data import stats
+from data.glyph import BaseGlyphLoader, share_glyphs
+import generator.generator as gen
+from generator.shards import ShardWriter, encode_image, image_format_for_mode
+
+PIPELINE_QUEUE_SIZE = 16  # max pages waiting between two stages
+PIPELINE_POLL_INTERVAL = 0.1  # seconds between checks for failures in other stages while blocked
+
+_STOP = object()  # end of stream
+
+
+class PipelineAborted(Exception):
+    """
+    Raised in a stage when another stage failed.
+    """
+
+
+class Pipeline:
+    """
+    Generates pages with a separate stage for each step:
+
+    sample: picks the page text and derives the page seed (one thread, reads `data` lazily)
+    layout: `layout_page` with a random.Random seeded per page (`layout_threads`)
+    raster: `composite_page` in a process pool with glyphs in shared memory (`raster_processes`)
+    encode: JPEG/PNG encoding (`encode_threads`, Pillow releases the GIL while encoding)
+    sink: writes .jpg/.txt files (`sink_threads`) or tar shards (one thread)
+
+    Pages are seeded like in `run_job`, from their text key and variant, so the output
+    doesn't depend on the concurrency of any stage. Pages of { key: text } are also numbered like
+    in `run_job` (every text in variant 0, then every text in variant 1, ...), so with all
+    variants both write the same pages under the same names. An iterable of (key, text) is only
+    read once, so each text is rendered in all variants before the next one is read, and pages
+    are numbered in that order instead.
+    """
+
+    def __init__(self, gl: BaseGlyphLoader, output_dir=None, shard_dir=None, mode=None, seed=gen.JOB_SEED,
+                 layout_threads=1, raster_processes=gen.MAX_WORKERS, encode_threads=2, sink_threads=2,
+                 queue_size=PIPELINE_QUEUE_SIZE, shard_size=gen.SHARD_SIZE, stats_path=gen.STATS_PATH, scales=None):
+        """
+        :param gl:
+        :param output_dir: directory to write .jpg/.txt files to
+        :param shard_dir: directory to write tar shards to (instead of output_dir)
+        :param mode: pixel mode, see `generate_page_data` (GLOBAL_PIXEL_MODE if None)
+        :param seed: seed that page seeds are derived from
+        :param layout_threads:
+        :param raster_processes:
+        :param encode_threads:
+        :param sink_threads: ignored for shards, which are written by a single thread
+        :param queue_size: max pages waiting between two stages
+        :param shard_size: pages per shard
+        :param stats_path: if specified, write statistics of all stages and processes here at the end
+        :param scales: write every page at each of these scales, downsampled from a single raster, into
+        a subdirectory per scale (see `generate_page_scales`). GLOBAL_OUTPUT_SCALES if None.
+        """
+        if (output_dir is None) == (shard_dir is None):
+            raise ValueError("Specify either output_dir or shard_dir")
+        self.gl = gl
+        self.output_dir = output_dir
+        self.shard_dir = shard_dir
+        self.mode = gen.GLOBAL_PIXEL_MODE if mode is None else mode
+        self.image_format = image_format_for_mode(self.mode)
+        self.seed = seed
+        self.layout_threads = layout_threads
+        self.raster_processes = raster_processes
+        self.encode_threads = encode_threads
+        self.sink_threads = 1 if shard_dir else sink_threads
+        self.queue_size = queue_size
+        self.shard_size = shard_size
+        self.stats_path = stats_path
+        self.scales = gen.GLOBAL_OUTPUT_SCALES if scales is None else scales
+        self.subdirs = gen._output_subdirs(self.scales)
+
+        self._abort = threading.Event()
+        self._errors = []
+        self._worker_stats = []
+        self._worker_stats_lock = threading.Lock()
+        self._shard_writers = None  # { subdir: ShardWriter }
+        self._progress = None
+        self._progress_lock = threading.Lock()
+
+    def run(self, data, characters_per_page, variants=None):
+        """
+        :param data: { key: text } or iterable of (key, text), e.g., TextLoader.iter_data
+        :param characters_per_page:
+        :param variants: glyph variants to render each text in (all if None)
+        :return: number of pages written
+        """
+        variants = list(range(self.gl.variants)) if variants is None else list(variants)
+        self._abort.clear()
+        self._errors = []
+        self._worker_stats = []
+
+        if self.output_dir:
+            gen._make_output_dirs(self.output_dir, self.scales)
+        else:
+            self._shard_writers = {subdir: ShardWriter(os.path.join(self.shard_dir, subdir),
+                                                       max_records=self.shard_size, image_format=self.image_format)
+                                   for subdir in self.subdirs}
+        if self.stats_path:
+            stats.enable()
+
+        layout_queue = queue.Queue(self.queue_size)
+        raster_queue = queue.Queue(self.queue_size)
+        inflight_queue = queue.Queue(self.raster_processes * 2)  # AsyncResults, in submission order
+        encode_queue = queue.Queue(self.queue_size)
+        sink_queue = queue.Queue(self.queue_size)
+
+        with stats.timer("glyph.share"):
+            shared = share_glyphs(self.gl, normalized_size=(gen.GLOBAL_CW_WIDTH, gen.GLOBAL_CW_HEIGHT))
+        pool = multiprocessing.Pool(self.raster_processes, initializer=gen._init_worker,
+                                    initargs=(shared, stats.is_enabled(), gen._worker_settings()))
+        try:
+            with tqdm.tqdm() as self._progress:
+                threads = [self._thread(self._sample, data, variants, characters_per_page, layout_queue)]
+                threads += self._stage("layout", self._layout, self.layout_threads, layout_queue, raster_queue, 1)
+                threads += self._stage("raster.submit", lambda item: self._submit(pool, item), 1, raster_queue,
+                                       inflight_queue, 1)
+                threads += self._stage("raster", self._collect, 1, inflight_queue, encode_queue, self.encode_threads)
+                threads += self._stage("encode", self._encode, self.encode_threads, encode_queue, sink_queue,
+                                       self.sink_threads)
+                threads += self._stage("sink", self._sink, self.sink_threads, sink_queue, None, 0,
+                                       on_finish=self._finish_sink)
+                for thread in threads:
+                    thread.join()
+                pages = self._progress.n
+        finally:
+            self._abort.set()  # stops the stages if the main thread was interrupted
+            # No more than 2 * raster_processes tasks are submitted, so let them finish instead of
+            # calling pool.terminate(), which can deadlock on the lock of the task queue.
+            pool.close()
+            try:
+                pool.join()
+            finally:
+                shared.unlink()
+                if self._shard_writers is not None and self._errors:  # all stages have stopped
+                    for writer in self._shard_writers.values():
+                        writer.abort()
+                self._shard_writers = None
+
+        if self._errors:
+            raise self._errors[0]
+        if self.stats_path:
+            stats.dump(stats.merge(self._worker_stats + [stats.snapshot()]), self.stats_path)
+        return pages
+
+    # Stages
+
+    def _sample(self, data, variants, characters_per_page, outbox):
+        if isinstance(data, dict):
+            pages = ((key, text, variant) for variant in variants for key, text in data.items())
+        else:
+            pages = ((key, text, variant) for key, text in data for variant in variants)
+        for i, (key, text, variant) in enumerate(pages):
+            with stats.timer("pipeline.sample"):
+                seed = gen.derive_seed(self.seed, key, variant)
+                offset, string = gen._select_page_text(text, characters_per_page, random.Random(seed))
+            self._put(outbox, (i, key, variant, offset, seed, string))
+        for _ in range(self.layout_threads):
+            self._put(outbox, _STOP)
+
+    def _layout(self, item):
+        i, key, variant, offset, seed, string = item
+        layout = gen.layout_page(string, variant, random.Random(seed))
+        return (i, key, variant, offset, seed, "\n".join(layout.lines)), layout
+
+    def _submit(self, pool, item):
+        page, layout = item
+        return page, pool.apply_async(_raster_task, (layout, self.mode, self.scales))
+
+    def _collect(self, item):
+        page, result = item
+        while True:
+            try:
+                images, snapshot = result.get(PIPELINE_POLL_INTERVAL)
+                break
+            except multiprocessing.TimeoutError:
+                if self._abort.is_set():
+                    raise PipelineAborted()
+        if snapshot:
+            with self._worker_stats_lock:
+                self._worker_stats = [stats.merge(self._worker_stats + [snapshot])]
+        return page, images
+
+    def _encode(self, item):
+        page, images = item
+        return page, [(subdir, encode_image(image, self.image_format)) for subdir, image in images]
+
+    def _sink(self, item):
+        (i, key, variant, offset, seed, text), encoded = item
+        name = gen._page_name(i, key, variant, offset)
+        for subdir, data in encoded:
+            if self._shard_writers is not None:
+                metadata = {"key": key, "variant": variant, "offset": offset, "seed": seed}
+                self._shard_writers[subdir].write(name, data, text, metadata)
+            else:
+                output_dir = os.path.join(self.output_dir, subdir)
+                with open(os.path.join(output_dir, "{}.{}".format(name, self.image_format)), "wb") as f:
+                    f.write(data)
+                with open(os.path.join(output_dir, name + ".txt"), "w") as f:
+                    f.write(text)
+                stats.increment("bytes.written", len(data))
+        with self._progress_lock:
+            self._progress.update(1)
+
+    def _finish_sink(self):
+        if self._shard_writers is not None:
+            for writer in self._shard_writers.values():
+                writer.close()
+
+    # Plumbing
+
+    def _stage(self, name, fn, threads, inbox, outbox, downstream_threads, on_finish=None):
+        """
+        Starts `threads` threads that apply `fn` to items from `inbox` and put the results into
+        `outbox`. The last thread to finish calls `on_finish` and sends one _STOP per downstream
+        thread.
+        """
+        remaining = [threads]
+        lock = threading.Lock()
+
+        def run():
+            while True:
+                item = self._get(inbox)
+                if item is _STOP:
+                    break
+                start = time.perf_counter()
+                result = fn(item)
+                stats.record("pipeline." + name, time.perf_counter() - start)
+                if outbox is not None:
+                    self._put(outbox, result)
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                if on_finish:
+                    on_finish()
+                for _ in range(downstream_threads):
+                    self._put(outbox, _STOP)
+
+        return [self._thread(run) for _ in range(threads)]
+
+    def _thread(self, fn, *args):
+        def run():
+            try:
+                fn(*args)
+            except PipelineAborted:
+                pass
+            except BaseException as e:
+                self._errors.append(e)
+                self._abort.set()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def _put(self, q, item):
+        """
+        Blocks while `q` is full (backpressure), unless another stage failed. Time spent blocked is
+        recorded as "pipeline.blocked".
+        """
+        start = None
+        while True:
+            try:
+                q.put(item, timeout=PIPELINE_POLL_INTERVAL if start else 0)
+                if start:
+                    stats.record("pipeline.blocked", time.perf_counter() - start)
+                return
+            except queue.Full:
+                start = start or time.perf_counter()
+                if self._abort.is_set():
+                    raise PipelineAborted()
+
+    def _get(self, q):
+        while True:
+            try:
+                return q.get(timeout=PIPELINE_POLL_INTERVAL)
+            except queue.Empty:
+                if self._abort.is_set():
+                    raise PipelineAborted()
+
+
+def _raster_task(layout, mode, scales):
+    """
+    Runs in a pool worker (see `generator._init_worker`).
+
+    :return: ([(output subdirectory, page image)], statistics since the last task)
+    """
+    if scales:
+        pages = gen.render_page_scales(gen._worker_gl, layout, scales, mode)
+        images = [(gen.scale_dir_name(scale), page) for scale, page in pages.items()]
+    else:
+        with stats.timer("page.composite"):
+            images = [("", gen.composite_page(gen._worker_gl, layout, mode))]
+        stats.increment("pages.rendered")
+        stats.increment("glyphs.rendered", len(layout.placements))
+    return images, stats.snapshot(reset=True) if stats.is_enabled() else None
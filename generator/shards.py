@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sharded dataset storage. Pages are streamed into fixed-size tar files instead of two small files
+per page. Each record is stored as consecutive tar members with a shared name:
+
+    <name>.jpg   encoded page image
+    <name>.txt   text (with linebreaks)
+    <name>.json  metadata, e.g., {"key": ..., "variant": ..., "offset": ..., "seed": ...}
+"""
+
+import glob
+import io
+import json
+import os
+import tarfile
+import time
+from typing import Dict, Iterator, NamedTuple
+
+from PIL import Image
+
+from data import stats
+
+SHARD_PATTERN = "{prefix}-{index:06d}.tar"
+
+
+class ShardRecord(NamedTuple):
+    name: str
+    image: bytes  # encoded image
+    text: str
+    metadata: Dict
+
+    def load_image(self) -> Image.Image:
+        return Image.open(io.BytesIO(self.image))
+
+
+class ShardWriter:
+    """
+    Writes records into numbered tar shards in `output_dir`, starting a new shard every `max_records`
+    records (or once a shard exceeds `max_bytes`). Shards are written under a temporary name and
+    renamed when complete, so readers never see partial shards. If the `with` block raises, the shard
+    in progress is discarded.
+
+    Usage:
+        with ShardWriter(output_dir) as writer:
+            writer.write(name, image, text, {"variant": variant})
+    """
+
+    def __init__(self, output_dir, prefix="shard", max_records=1000, max_bytes=None, start_index=0,
+                 image_format="jpg"):
+        """
+        :param output_dir:
+        :param prefix: shard filename prefix
+        :param max_records: max records per shard
+        :param max_bytes: max (approximate) bytes per shard. Unlimited if None.
+        :param start_index: index of the first shard
+        :param image_format: "jpg" or "png". Used to encode PIL images passed to `write`.
+        """
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.image_format = image_format
+        self.index = start_index
+        self.tar = None
+        self.path = None
+        self.records = 0
+        self.bytes = 0
+        self.paths = []  # completed shards
+        os.makedirs(output_dir, exist_ok=True)
+
+    def write(self, name, image, text, metadata=None):
+        """
+        :param name: record name, unique within the dataset
+        :param image: PIL image, or encoded image bytes in `self.image_format`
+        :param text: page text (with linebreaks)
+        :param metadata: JSON-serializable dict
+        """
+        if isinstance(image, Image.Image):
+            with stats.timer("page.encode"):
+                image = encode_image(image, self.image_format)
+        if self.tar is None:
+            self._open()
+
+        with stats.timer("page.write"):
+            self._add(name + "." + self.image_format, image)
+            self._add(name + ".txt", text.encode("utf-8"))
+            self._add(name + ".json", json.dumps(metadata or {}, ensure_ascii=False).encode("utf-8"))
+        self.records += 1
+
+        if self.records >= self.max_records or (self.max_bytes and self.bytes >= self.max_bytes):
+            self._finish()
+
+    def close(self):
+        if self.tar is not None:
+            self._finish()
+
+    def abort(self):
+        """
+        Discards the shard in progress. Completed shards are kept.
+        """
+        if self.tar is not None:
+            self.tar.close()
+            os.remove(self.path + ".tmp")
+            self.tar = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _open(self):
+        self.path = os.path.join(self.output_dir, SHARD_PATTERN.format(prefix=self.prefix, index=self.index))
+        self.tar = tarfile.open(self.path + ".tmp", "w")
+        self.records = 0
+        self.bytes = 0
+
+    def _add(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.tar.addfile(info, io.BytesIO(data))
+        self.bytes += len(data)
+        stats.increment("bytes.written", len(data))
+
+    def _finish(self):
+        self.tar.close()
+        os.replace(self.path + ".tmp", self.path)
+        self.paths.append(self.path)
+        self.tar = None
+        self.index += 1
+
+
+def encode_image(image: Image.Image, image_format="jpg") -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format={"jpg": "JPEG", "png": "PNG"}[image_format])
+    return buffer.getvalue()
+
+
+def image_format_for_mode(mode):
+    """
+    :return: "png" for bilevel ("1") images, which JPEG can't store, otherwise "jpg"
+    """
+    return "png" if mode == "1" else "jpg"
+
+
+def list_shards(shard_dir, prefix="shard"):
+    """
+    :return: sorted paths of all complete shards in `shard_dir`
+    """
+    return sorted(glob.glob(os.path.join(shard_dir, "{}-*.tar".format(prefix))))
+
+
+def read_shards(paths) -> Iterator[ShardRecord]:
+    """
+    Reads records sequentially from one or more shards.
+
+    :param paths: shard path, list of shard paths, or a directory of shards
+    :return: iterator of ShardRecord
+    """
+    if isinstance(paths, str):
+        paths = list_shards(paths) if os.path.isdir(paths) else [paths]
+
+    for path in paths:
+        # Stream mode: members are read strictly in order without seeking
+        with tarfile.open(path, "r|") as tar:
+            record = None  # { "name": ..., ext: data }
+            for member in tar:
+                name, ext = member.name.rsplit(".", 1)
+                if record is not None and record["name"] != name:
+                    yield _make_record(record)
+                    record = None
+                if record is None:
+                    record = {"name": name}
+                record[ext] = tar.extractfile(member).read()
+            if record is not None:
+                yield _make_record(record)
+
+
+def _make_record(record) -> ShardRecord:
+    image = record.get("jpg", record.get("png"))
+    text = record.get("txt", b"").decode("utf-8")
+    metadata = json.loads(record.get("json", b"{}").decode("utf-8"))
+    return ShardRecord(record["name"], image, text, metadata)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""
+Background page writer. Pages are encoded (JPEG/PNG) and written on a few threads while the caller
+renders the next page. Pillow releases the GIL while encoding, so this overlaps compression and disk
+I/O with rasterization without extra processes.
+"""
+
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from data import stats
+from generator.shards import ShardWriter, encode_image, image_format_for_mode
+
+WRITER_THREADS = 2  # encoding threads per PageWriter (0 to encode and write synchronously)
+WRITER_MAX_PENDING = 8  # max pages queued per PageWriter before `write` blocks
+
+
+class PageWriter:
+    """
+    Writes pages as <output_dir>/<name>.<jpg|png> and <name>.txt, or as records of a ShardWriter.
+    Encoding (and, for files, writing) happens on background threads. At most `max_pending` pages
+    are queued; `write` waits for the oldest page beyond that, so memory stays bounded when the disk
+    is slower than the renderer. Shard records are appended in the order they were submitted.
+
+    Usage:
+        with PageWriter(output_dir) as writer:
+            writer.write(name, image, text)
+    """
+
+    def __init__(self, output_dir=None, shard_writer: ShardWriter = None, image_format=None, threads=WRITER_THREADS,
+                 max_pending=WRITER_MAX_PENDING):
+        """
+        :param output_dir: directory to write pages to (if `shard_writer` is None)
+        :param shard_writer: ShardWriter to append pages to
+        :param image_format: "jpg" or "png" (default: PNG for "1" images, otherwise JPEG). Ignored
+        when writing to shards, which use the shard writer's format.
+        :param threads: encoding threads (0 to encode and write synchronously in `write`)
+        :param max_pending: max pages queued
+        """
+        if (output_dir is None) == (shard_writer is None):
+            raise ValueError("Specify either output_dir or shard_writer")
+        self.output_dir = output_dir
+        self.shard_writer = shard_writer
+        self.image_format = shard_writer.image_format if shard_writer else image_format
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(threads) if threads else None
+        self.pending = deque()  # (future, name, text, metadata), oldest first
+
+    def write(self, name, image: Image.Image, text, metadata=None):
+        """
+        :param name: page name, without extension
+        :param image: page image. Don't modify it afterwards.
+        :param text: page text (with linebreaks)
+        :param metadata: JSON-serializable dict (shards only)
+        """
+        if self.executor is None:
+            self._finish(self._encode(name, image, text), name, text, metadata)
+            return
+        self.pending.append((self.executor.submit(self._encode, name, image, text), name, text, metadata))
+        while len(self.pending) > self.max_pending:
+            self._finish_pending()
+
+    def flush(self):
+        """
+        Waits until all queued pages are written. Errors from background threads are raised here
+        (or in `write`).
+        """
+        while self.pending:
+            self._finish_pending()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _encode(self, name, image, text):
+        """
+        Runs on a background thread.
+
+        :return: (encoded image, encode seconds, write seconds)
+        """
+        start = time.perf_counter()
+        image_format = self.image_format or image_format_for_mode(image.mode)
+        data = encode_image(image, image_format)
+        encoded = time.perf_counter()
+        if self.shard_writer is None:
+            with open(os.path.join(self.output_dir, "{}.{}".format(name, image_format)), "wb") as f:
+                f.write(data)
+            with open(os.path.join(self.output_dir, name + ".txt"), "w") as f:
+                f.write(text)
+        return data, encoded - start, time.perf_counter() - encoded
+
+    def _finish_pending(self):
+        future, name, text, metadata = self.pending.popleft()
+        with stats.timer("page.wait"):
+            result = future.result()
+        self._finish(result, name, text, metadata)
+
+    def _finish(self, result, name, text, metadata):
+        data, encode_seconds, write_seconds = result
+        stats.record("page.encode", encode_seconds)
+        if self.shard_writer is None:
+            stats.record("page.write", write_seconds)
+            stats.increment("bytes.written", len(data))
+        else:
+            self.shard_writer.write(name, data, text, metadata)